@@ -11,6 +11,7 @@ pyinstaller ./src/quick_replay_controller.py ^
 --add-binary ./assets/next.png;./assets ^
 --add-binary ./assets/prev.png;./assets ^
 --add-binary ./assets/play.png;./assets ^
+--add-binary ./assets/play_reverse.png;./assets ^
 --add-binary ./assets/pause.png;./assets ^
 --add-binary ./assets/record.png;./assets ^
 --add-binary ./assets/stop.png;./assets ^
@@ -0,0 +1,241 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+"""
+録画(書き込み)からリプレイ(読み込み)までのベンチマーク。
+SyntheticFrameSourceの映像をRingVideoWriterで書き込み、RingVideoCaptureで読み込んで以下を計測する。
+
+* write fps        : フレームレートに合わせずに書き込んだときの書き込み速度
+* high water       : フレームレートに合わせて書き込んだときにバッファに溜まったフレーム数の最大値
+* drop             : フレームレートに合わせて書き込んだときに捨てたフレーム数
+* rotation         : セグメント切り替えにかかった時間(書き込み側)
+* boundary read    : セグメントの先頭フレームの読み込みにかかった時間(読み込み側)
+* move_frame/move_diff : シークして1フレーム読み込むまでの時間(p50/p95/p99)
+
+例) python src/benchmark_ring_video.py --resolutions 1920x1080 --frame-rates 60 --codecs mp4v,MJPG
+"""
+
+import argparse
+import csv
+import os
+import random
+import tempfile
+from dataclasses import asdict, dataclass
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from codec import Codec, CODECS, get_codec
+from frame_source import SyntheticFrameSource
+from ring_video import OverflowPolicy, RingVideoCapture, RingVideoWriter
+
+SEEK_NUM = 100  # シーク時間の計測回数
+FAST_MOVE_FRAME = 20
+
+
+@dataclass
+class BenchmarkResult(object):
+    resolution: str
+    frame_rate: int
+    codec: str
+    file_length: float
+    write_fps: float
+    high_water: int
+    drop: int
+    rotation_ms_p50: float
+    rotation_ms_max: float
+    boundary_read_ms: float
+    read_ms_p50: float
+    move_frame_ms_p50: float
+    move_frame_ms_p95: float
+    move_frame_ms_p99: float
+    move_diff_prev_ms_p50: float
+    move_diff_prev_ms_p95: float
+    move_diff_prev_ms_p99: float
+    move_diff_fast_ms_p50: float
+    move_diff_fast_ms_p95: float
+    move_diff_fast_ms_p99: float
+
+
+def percentile_ms(times: List[float], q: float) -> float:
+    if len(times) == 0:
+        return 0.0
+    return round(float(np.percentile(times, q)) * 1000, 3)
+
+
+def create_file_list(folder: str, extension: str, file_num: int) -> List[str]:
+    return [os.path.join(folder, f"bench{i}{extension}") for i in range(file_num)]
+
+
+def write_frames(
+    file_list: List[str],
+    codec: Codec,
+    width: int,
+    height: int,
+    frame_rate: int,
+    file_length: float,
+    frame_num: int,
+    is_realtime: bool,
+) -> Tuple[float, RingVideoWriter]:
+    # フレームレートに合わせる場合は実際の録画と同じ動作、合わせない場合は書き込める速度の上限を測る
+    policy = OverflowPolicy.DROP_NEWEST if is_realtime else OverflowPolicy.BLOCK
+    source = SyntheticFrameSource(width, height, frame_rate, is_realtime=is_realtime, frame_num_max=frame_num)
+    writer = RingVideoWriter(
+        file_list,
+        codec.get_fourcc(),
+        frame_rate,
+        (width, height),
+        file_length,
+        keyframe_interval=codec.keyframe_interval,
+        overflow_policy=policy,
+    )
+    start_time = perf_counter()
+    while True:
+        ret, frame = source.read()
+        if not ret:
+            break
+        writer.write(frame)
+    writer.release()
+    return perf_counter() - start_time, writer
+
+
+def measure_seek(capture: RingVideoCapture) -> Dict[str, List[float]]:
+    frame_num = capture.get_frame_num()
+    rand = random.Random(0)
+    times: Dict[str, List[float]] = {"move_frame": [], "move_diff_prev": [], "move_diff_fast": []}
+
+    for _ in range(SEEK_NUM):
+        target = rand.randrange(frame_num)
+        start_time = perf_counter()
+        capture.move_frame(target)
+        capture.read()
+        times["move_frame"].append(perf_counter() - start_time)
+
+    # ReplayerModel.prev_frame / fast_foward と同じ動作
+    capture.move_last()
+    capture.read()
+    for _ in range(min(SEEK_NUM, frame_num - 1)):
+        start_time = perf_counter()
+        capture.move_diff(-2)
+        capture.read()
+        times["move_diff_prev"].append(perf_counter() - start_time)
+
+    capture.move_first()
+    capture.read()
+    for _ in range(min(SEEK_NUM, frame_num // FAST_MOVE_FRAME)):
+        start_time = perf_counter()
+        capture.move_diff(FAST_MOVE_FRAME - 1)
+        capture.read()
+        times["move_diff_fast"].append(perf_counter() - start_time)
+    return times
+
+
+def measure_sequential_read(capture: RingVideoCapture, boundaries: List[int]) -> Tuple[List[float], List[float]]:
+    # 先頭から順に読み込み、セグメントの先頭フレームとそれ以外の読み込み時間を分けて返す
+    boundary_times = []
+    read_times = []
+    capture.move_first()
+    for i in range(capture.get_frame_num()):
+        start_time = perf_counter()
+        capture.read()
+        elapsed = perf_counter() - start_time
+        if i in boundaries:
+            boundary_times.append(elapsed)
+        else:
+            read_times.append(elapsed)
+    return boundary_times, read_times
+
+
+def run(resolution: str, frame_rate: int, codec: Codec, file_length: float, duration: float) -> BenchmarkResult:
+    width, height = [int(tmp) for tmp in resolution.split("x")]
+    frame_num = int(frame_rate * duration)
+    file_num = int(duration / file_length) + 2
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_list = create_file_list(folder, codec.extension, file_num)
+        elapsed, _ = write_frames(file_list, codec, width, height, frame_rate, file_length, frame_num, False)
+        write_fps = frame_num / elapsed
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_list = create_file_list(folder, codec.extension, file_num)
+        _, writer = write_frames(file_list, codec, width, height, frame_rate, file_length, frame_num, True)
+        stats = writer.get_stats()
+        files = writer.release()
+
+        capture = RingVideoCapture(files)
+        segment_frame_num = int(frame_rate * file_length)
+        boundaries = list(range(segment_frame_num, capture.get_frame_num(), segment_frame_num))
+        boundary_times, read_times = measure_sequential_read(capture, boundaries)
+        seek_times = measure_seek(capture)
+        capture.release()
+
+    return BenchmarkResult(
+        resolution=resolution,
+        frame_rate=frame_rate,
+        codec=codec.name,
+        file_length=file_length,
+        write_fps=round(write_fps, 1),
+        high_water=stats.high_water_num,
+        drop=stats.dropped_frame_num,
+        rotation_ms_p50=percentile_ms(stats.rotation_times, 50),
+        rotation_ms_max=percentile_ms(stats.rotation_times, 100),
+        boundary_read_ms=percentile_ms(boundary_times, 50),
+        read_ms_p50=percentile_ms(read_times, 50),
+        move_frame_ms_p50=percentile_ms(seek_times["move_frame"], 50),
+        move_frame_ms_p95=percentile_ms(seek_times["move_frame"], 95),
+        move_frame_ms_p99=percentile_ms(seek_times["move_frame"], 99),
+        move_diff_prev_ms_p50=percentile_ms(seek_times["move_diff_prev"], 50),
+        move_diff_prev_ms_p95=percentile_ms(seek_times["move_diff_prev"], 95),
+        move_diff_prev_ms_p99=percentile_ms(seek_times["move_diff_prev"], 99),
+        move_diff_fast_ms_p50=percentile_ms(seek_times["move_diff_fast"], 50),
+        move_diff_fast_ms_p95=percentile_ms(seek_times["move_diff_fast"], 95),
+        move_diff_fast_ms_p99=percentile_ms(seek_times["move_diff_fast"], 99),
+    )
+
+
+def print_result(result: BenchmarkResult) -> None:
+    print(
+        f"{result.resolution:>9} {result.frame_rate:3d}fps {result.codec:>4} seg {result.file_length:5.1f}s | "
+        f"write {result.write_fps:7.1f}fps  high water {result.high_water:3d}  drop {result.drop:4d} | "
+        f"rotation p50 {result.rotation_ms_p50:7.3f}ms max {result.rotation_ms_max:7.3f}ms | "
+        f"read {result.read_ms_p50:6.3f}ms boundary {result.boundary_read_ms:7.3f}ms | "
+        f"move_frame p50/p95/p99 {result.move_frame_ms_p50:.3f}/{result.move_frame_ms_p95:.3f}/"
+        f"{result.move_frame_ms_p99:.3f}ms | "
+        f"prev {result.move_diff_prev_ms_p50:.3f}/{result.move_diff_prev_ms_p95:.3f}/"
+        f"{result.move_diff_prev_ms_p99:.3f}ms | "
+        f"fast {result.move_diff_fast_ms_p50:.3f}/{result.move_diff_fast_ms_p95:.3f}/"
+        f"{result.move_diff_fast_ms_p99:.3f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="RingVideoWriter / RingVideoCapture benchmark")
+    parser.add_argument("--resolutions", default="640x360,1280x720,1920x1080")
+    parser.add_argument("--frame-rates", default="30,60,120")
+    parser.add_argument("--codecs", default="mp4v,MJPG", help=f"{', '.join(codec.name for codec in CODECS)}")
+    parser.add_argument("--file-lengths", default="2,10", help="セグメントの長さ[s] (FILE_LENGTH)")
+    parser.add_argument("--duration", type=float, default=5.0, help="1条件あたりの録画時間[s]")
+    parser.add_argument("--csv", default=None, help="結果をCSVに保存する")
+    args = parser.parse_args()
+
+    results = []
+    for resolution in args.resolutions.split(","):
+        for frame_rate in [int(tmp) for tmp in args.frame_rates.split(",")]:
+            for codec in [get_codec(tmp) for tmp in args.codecs.split(",")]:
+                for file_length in [float(tmp) for tmp in args.file_lengths.split(",")]:
+                    result = run(resolution, frame_rate, codec, file_length, args.duration)
+                    print_result(result)
+                    results.append(result)
+
+    if args.csv is not None:
+        with open(args.csv, "w", newline="", encoding="UTF-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(asdict(results[0]).keys()))
+            writer.writeheader()
+            for result in results:
+                writer.writerow(asdict(result))
+
+
+if __name__ == "__main__":
+    main()
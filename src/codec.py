@@ -0,0 +1,99 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+import os
+import tempfile
+from dataclasses import dataclass
+from time import perf_counter, process_time
+from typing import List, Optional
+
+import cv2
+
+from frame_source import SyntheticFrameSource
+
+
+@dataclass
+class Codec(object):
+    name: str
+    fourcc: str  # 空文字の場合は無圧縮
+    extension: str
+    keyframe_interval: int  # cv2.VideoWriter(FFMPEG)はGOPを12フレームで出力する。フレーム内圧縮のみの場合は1
+
+    def get_fourcc(self) -> int:
+        if self.fourcc == "":
+            return 0
+        return cv2.VideoWriter_fourcc(*self.fourcc)
+
+
+CODEC_AUTO = "auto"
+CODECS = [
+    Codec("mp4v", "mp4v", ".mp4", 12),
+    Codec("MJPG", "MJPG", ".avi", 1),
+    Codec("XVID", "XVID", ".avi", 12),
+    Codec("FFV1", "FFV1", ".avi", 12),
+    Codec("raw", "", ".avi", 1),
+]
+# 無圧縮は書き込みは速いがリプレイ時間に対して容量が大きくなりすぎるため自動選択の対象にしない
+AUTO_CODECS = [codec for codec in CODECS if codec.name != "raw"]
+
+
+def get_codec(name: str) -> Optional[Codec]:
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    return None
+
+
+@dataclass
+class CalibrationResult(object):
+    codec: Codec
+    frame_rate: float  # 書き込み速度[fps]
+    cpu_usage: float  # 指定のフレームレートで書き込んだ場合のCPU使用率(1コア=1.0)
+
+
+def measure_codec(codec: Codec, width: int, height: int, frame_rate: int, length: float) -> Optional[CalibrationResult]:
+    # length秒分のフレームを書き込み、書き込み速度とCPU使用率を測る。使用できないコーデックの場合はNone
+    frame_num = max(1, int(frame_rate * length))
+    # 映像の生成時間を含めないように予め作っておく
+    source = SyntheticFrameSource(width, height, frame_rate, is_realtime=False)
+    frames = [source.read()[1] for _ in range(min(frame_num, 30))]
+
+    with tempfile.TemporaryDirectory() as folder:
+        writer = cv2.VideoWriter(
+            os.path.join(folder, f"calibration{codec.extension}"), codec.get_fourcc(), frame_rate, (width, height)
+        )
+        if not writer.isOpened():
+            return None
+        start_time = perf_counter()
+        start_cpu_time = process_time()
+        for i in range(frame_num):
+            writer.write(frames[i % len(frames)])
+        writer.release()
+        elapsed = perf_counter() - start_time
+        cpu_time = process_time() - start_cpu_time
+
+    return CalibrationResult(codec, frame_num / elapsed, cpu_time / (frame_num / frame_rate))
+
+
+def calibrate(
+    width: int,
+    height: int,
+    frame_rate: int,
+    cpu_budget: float,
+    length: float = 2.0,
+    codecs: List[Codec] = AUTO_CODECS,
+) -> Codec:
+    """
+    各コーデックで実際に書き込んでみて、指定のフレームレートをCPU使用率cpu_budget以内で書き込めるものの中から最も速いものを選ぶ。
+    条件を満たすものが無い場合は最も速いものを選ぶ。
+    """
+    results = [measure_codec(codec, width, height, frame_rate, length) for codec in codecs]
+    results = [result for result in results if result is not None]
+    if len(results) == 0:
+        return CODECS[0]
+
+    candidates = [result for result in results if result.frame_rate >= frame_rate and result.cpu_usage <= cpu_budget]
+    if len(candidates) == 0:
+        candidates = results
+    return max(candidates, key=lambda result: result.frame_rate).codec
@@ -0,0 +1,78 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+from threading import Lock
+from typing import List, Optional, Union
+
+import cv2
+
+
+class PooledFrame(object):
+    """
+    FramePoolから借りたフレーム。
+    使う側はretainしてから使い、使い終わったらreleaseする。参照が無くなるとバッファがプールに戻る。
+    """
+
+    def __init__(self, pool: "FramePool", image: Optional[cv2.Mat]):
+        self.image = image
+        self._pool = pool
+        self._ref_count = 1
+        self._lock = Lock()
+
+    def retain(self) -> "PooledFrame":
+        with self._lock:
+            self._ref_count += 1
+        return self
+
+    def release(self) -> None:
+        with self._lock:
+            self._ref_count -= 1
+            is_free = self._ref_count == 0
+        if is_free:
+            self._pool._give_back(self.image)
+
+
+class FramePool(object):
+    """
+    録画中のフレーム用のバッファを使いまわす。
+    capture.read(image)に空いているバッファを渡すことで、フレームごとに配列を確保しないようにする。
+    空いているバッファが無い場合はcapture.read側で新しく確保され、返却時にbuffer_num_maxまでプールに残る。
+    """
+
+    def __init__(self, buffer_num_max: int):
+        self._free: List[cv2.Mat] = []
+        self._buffer_num_max = buffer_num_max
+        self._lock = Lock()
+
+    def acquire(self) -> PooledFrame:
+        # 取得した時点で参照カウントは1になっている
+        with self._lock:
+            image = self._free.pop() if len(self._free) > 0 else None
+        return PooledFrame(self, image)
+
+    def _give_back(self, image: Optional[cv2.Mat]) -> None:
+        if image is None:
+            return
+        with self._lock:
+            if len(self._free) < self._buffer_num_max:
+                self._free.append(image)
+
+
+# 以下はプールを使わない通常の配列(リプレイ時のフレームなど)もそのまま扱えるようにするための関数
+
+
+def as_image(frame: Union[cv2.Mat, PooledFrame]) -> cv2.Mat:
+    if isinstance(frame, PooledFrame):
+        return frame.image
+    return frame
+
+
+def retain_frame(frame: Union[cv2.Mat, PooledFrame]) -> None:
+    if isinstance(frame, PooledFrame):
+        frame.retain()
+
+
+def release_frame(frame: Union[cv2.Mat, PooledFrame]) -> None:
+    if isinstance(frame, PooledFrame):
+        frame.release()
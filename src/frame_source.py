@@ -0,0 +1,149 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+from time import perf_counter, sleep
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class FrameSource(object):
+    """
+    録画する映像の入力元。cv2.VideoCaptureと同じ形でread/releaseできる。
+    """
+
+    def is_opened(self) -> bool:
+        return True
+
+    def read(self, image: Optional[cv2.Mat] = None) -> Tuple[bool, Optional[cv2.Mat]]:
+        raise NotImplementedError()
+
+    def release(self) -> None:
+        pass
+
+
+class _Pacer(object):
+    # 指定のフレームレートになるように待つ
+    def __init__(self, frame_rate: float):
+        self._frame_rate = frame_rate
+        self._start_time: Optional[float] = None
+        self._counter = 0
+
+    def wait(self) -> None:
+        now = perf_counter()
+        if self._start_time is None:
+            self._start_time = now
+        target_time = self._start_time + self._counter / self._frame_rate
+        if now < target_time:
+            sleep(target_time - now)
+        self._counter += 1
+
+
+class DeviceFrameSource(FrameSource):
+    # Webカメラなどの入力デバイス
+    def __init__(self, device_num: int, width: int, height: int):
+        self._capture = cv2.VideoCapture(device_num, cv2.CAP_DSHOW)
+        if self._capture.isOpened():
+            self._capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            self._capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+
+    def is_opened(self) -> bool:
+        return self._capture.isOpened()
+
+    def read(self, image: Optional[cv2.Mat] = None) -> Tuple[bool, Optional[cv2.Mat]]:
+        return self._capture.read(image)
+
+    def release(self) -> None:
+        self._capture.release()
+
+
+class VideoFileFrameSource(FrameSource):
+    """
+    動画ファイルを入力デバイスの代わりに使う。
+    frame_rateを指定しない場合は動画ファイルのフレームレートで読み込む。is_loop=Trueの場合は最後まで読んだら先頭に戻る。
+    """
+
+    def __init__(self, file_path: str, frame_rate: Optional[float] = None, is_loop: bool = True):
+        self._capture = cv2.VideoCapture(file_path)
+        if frame_rate is None:
+            frame_rate = self._capture.get(cv2.CAP_PROP_FPS) or 30
+        self._pacer = _Pacer(frame_rate)
+        self._is_loop = is_loop
+
+    def is_opened(self) -> bool:
+        return self._capture.isOpened()
+
+    def read(self, image: Optional[cv2.Mat] = None) -> Tuple[bool, Optional[cv2.Mat]]:
+        self._pacer.wait()
+        ret, frame = self._capture.read(image)
+        if not ret and self._is_loop:
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self._capture.read(image)
+        return ret, frame
+
+    def release(self) -> None:
+        self._capture.release()
+
+
+class SyntheticFrameSource(FrameSource):
+    """
+    フレーム番号を描画した映像を生成する。同じフレーム番号には常に同じ映像が生成される。
+    is_realtime=Falseの場合はフレームレートに合わせて待たずに生成する(ベンチマーク用)。
+    frame_num_maxを指定した場合はその数だけ生成した後にreadが失敗する。
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        frame_rate: float = 60,
+        is_realtime: bool = True,
+        frame_num_max: Optional[int] = None,
+    ):
+        self._width = width
+        self._height = height
+        self._pacer = _Pacer(frame_rate) if is_realtime else None
+        self._frame_num_max = frame_num_max
+        self._counter = 0
+
+        # 背景のグラデーションは毎回作らずにコピーして使う
+        x = np.linspace(0, 255, width, dtype=np.uint8)
+        y = np.linspace(0, 255, height, dtype=np.uint8)
+        self._background = np.empty((height, width, 3), dtype=np.uint8)
+        self._background[:, :, 0] = x[np.newaxis, :]
+        self._background[:, :, 1] = y[:, np.newaxis]
+        self._background[:, :, 2] = 128
+
+    @staticmethod
+    def generate(frame_num: int, background: cv2.Mat, image: Optional[cv2.Mat] = None) -> cv2.Mat:
+        # フレーム番号を描画し、フレームごとに位置が変わる帯を入れて動きのある映像にする
+        if image is None or image.shape != background.shape:
+            image = background.copy()
+        else:
+            np.copyto(image, background)
+        height, width = background.shape[:2]
+        bar_width = max(1, width // 16)
+        bar_x = (frame_num * bar_width // 4) % width
+        image[:, bar_x : bar_x + bar_width] = 255
+        scale = height / 180
+        cv2.putText(
+            image,
+            str(frame_num),
+            (10, int(height * 0.6)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            scale,
+            (0, 0, 0),
+            max(1, int(scale * 3)),
+        )
+        return image
+
+    def read(self, image: Optional[cv2.Mat] = None) -> Tuple[bool, Optional[cv2.Mat]]:
+        if self._frame_num_max is not None and self._counter >= self._frame_num_max:
+            return False, None
+        if self._pacer is not None:
+            self._pacer.wait()
+        frame = SyntheticFrameSource.generate(self._counter, self._background, image)
+        self._counter += 1
+        return True, frame
@@ -0,0 +1,73 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+from dataclasses import dataclass
+from threading import Condition
+from time import perf_counter
+
+
+@dataclass
+class PlaybackStats(object):
+    shown_frame_num: int = 0
+    late_frame_num: int = 0  # 予定の時刻より1フレーム以上遅れて表示したフレーム数
+    skipped_frame_num: int = 0  # 遅れを取り戻すために表示せずに飛ばしたフレーム数
+    underrun_num: int = 0  # 予定の時刻にフレームが用意できておらず、前のフレームを表示し続けた回数
+    lateness_ms_max: float = 0.0
+
+
+class PlaybackClock(object):
+    """
+    再生開始からの経過時間で、どの位置(フレーム数。録画時刻の間隔から求めた小数も使える)を表示するべきかを決める。
+    フレームごとに待つ時間を積み重ねないため、表示が遅れても時刻がずれていかない。
+    再生速度を変えた場合は、その時点の位置から新しい速度で進む。
+    stopを呼ぶと待っているスレッドをすぐに戻す。
+    """
+
+    def __init__(self, frame_rate: float, speed: float = 1.0):
+        self._frame_rate = frame_rate
+        self._speed = speed
+        self._start_time = perf_counter()
+        self._start_index = 0.0  # 速度を変えた時点のフレーム位置
+        self._is_stopped = False
+        self._lock = Condition()
+
+    def set_speed(self, speed: float) -> None:
+        with self._lock:
+            now = perf_counter()
+            self._start_index = self._get_position(now)
+            self._start_time = now
+            self._speed = speed
+            # 待っている時間を新しい速度で計算し直させる
+            self._lock.notify_all()
+
+    def stop(self) -> None:
+        with self._lock:
+            self._is_stopped = True
+            self._lock.notify_all()
+
+    def get_position(self) -> float:
+        # 現在表示されているべき位置(再生開始からのフレーム数)
+        with self._lock:
+            return self._get_position(perf_counter())
+
+    def get_lateness(self, position: float) -> float:
+        # positionの予定時刻からの遅れ[s]。予定より早い場合は負の値
+        with self._lock:
+            return perf_counter() - self._get_time(position)
+
+    def wait(self, position: float) -> bool:
+        # positionの予定時刻まで待つ。stopで止められた場合はFalse
+        with self._lock:
+            while not self._is_stopped:
+                wait_time = self._get_time(position) - perf_counter()
+                if wait_time <= 0:
+                    return True
+                self._lock.wait(wait_time)
+            return False
+
+    def _get_position(self, now: float) -> float:
+        return self._start_index + (now - self._start_time) * self._frame_rate * self._speed
+
+    def _get_time(self, index: float) -> float:
+        return self._start_time + (index - self._start_index) / (self._frame_rate * self._speed)
@@ -5,30 +5,82 @@
 from contextlib import contextmanager
 from enum import Enum, auto
 import json
+import math
+import multiprocessing
 import os
-from queue import Queue
-from time import sleep, time
-from threading import Thread
+from time import perf_counter, sleep
+from threading import Lock, Thread
 import tkinter as tk
-from typing import Callable, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import webbrowser
 
 import cv2
+import numpy as np
 import ttkbootstrap as ttk
 
 from dataclasses import dataclass
 from quick_replay_view import SettingView, ReplayerView, InfoView
 from utils import tkvar_from_dict, tkvar_to_dict
-from ring_video import RingVideoWriter, RingVideoCapture
+from ring_video import (
+    RingVideoWriter,
+    RingVideoCapture,
+    JpegFrameRing,
+    MmapFrameRing,
+    FrameRingWriter,
+    FrameRingCapture,
+    FrameDecoder,
+    DecoderCommand,
+    OverflowPolicy,
+)
 from capture_device import get_devices
-
-FILE_LENGTH = 60  # 秒数
-FMT = cv2.VideoWriter_fourcc("m", "p", "4", "v")
+from frame_source import FrameSource, DeviceFrameSource
+from codec import CODECS, CODEC_AUTO, Codec, calibrate, get_codec
+from frame_pool import FramePool, PooledFrame, as_image, release_frame, retain_frame
+from recorder_process import RecordingProcess, RecordingProcessSettings, create_writer, run_recording
+from playback_clock import PlaybackClock, PlaybackStats
+from storage_planner import StoragePlanner, get_free_byte_num
+from thumbnail_index import ThumbnailIndex
+
+FILE_LENGTH = 4  # 秒数。1つのセグメントの長さ。リプレイ時間はセグメント単位ではなくタイムスタンプで切り詰める
+DEFAULT_CODEC = "mp4v"
+CODEC_LIST = [CODEC_AUTO] + [codec.name for codec in CODECS]
+CALIBRATION_LENGTH = 2  # 秒数。コーデックの自動選択時に試しに書き込む長さ
+CALIBRATION_CPU_BUDGET = 0.5  # コーデックの自動選択時に許容するCPU使用率(1コア=1.0)
+CALIBRATION_POLL_INTERVAL = 100  # ミリ秒。コーデックの自動選択が終わったかを確認する間隔
 WRITER_BUFFER_SIZE = 60  # フレーム数
+WRITER_OVERFLOW_POLICY = OverflowPolicy.ADAPTIVE  # 書き込みが間に合わないときの動作
+FRAME_POOL_SIZE = WRITER_BUFFER_SIZE + 8  # 録画中に使いまわすフレームのバッファ数
+MEMORY_JPEG_QUALITY = 90
+MEMORY_BYTE_BUDGET = 4 * 1024 * 1024 * 1024  # バイト数。メモリ保存でJPEGのリングに使うメモリの上限
+MEMORY_JPEG_RATIO = 4  # 無圧縮のフレームに対するJPEGの圧縮率。映像によって変わるため小さめに見積もる
+DECODE_CACHE_SIZE = 1024 * 1024 * 1024  # バイト数。コマ戻し用にデコード済みのフレームを保持する
+PREFETCH_BUFFER_SIZE = 30  # フレーム数。再生時に先読みしておく
+PLAY_GAP_MAX = 5  # フレーム数。録画を止めていた間など、タイムスタンプの間隔がこれより長い場合は不連続として扱う
+REVERSE_CHUNK_SIZE = 24  # フレーム数。逆再生時にまとめてデコードする
+PLAYBACK_SPEED_LIST = ["0.25x", "0.5x", "1x", "2x"]
+DEFAULT_PLAYBACK_SPEED = "1x"
+PREVIEW_FPS_MAX = 60  # プレビュー画面の更新頻度の上限
+PREVIEW_WIDTH_MAX = None  # ピクセル数。指定した場合はプレビュー画面をこの幅まで縮小して表示する
+PROXY_WIDTH = 480  # ピクセル数。ファイル保存の場合にシーク用のプロキシをこの幅で書き込む。Noneの場合は書き込まない
+PROXY_SETTLE_TIME = 0.15  # 秒数。プロキシでシークした後、操作がこの時間止まったらマスターをデコードする
+THUMBNAIL_INTERVAL = 15  # フレーム数。録画中にこのフレームごとにシークバー用のサムネイルを作る
+THUMBNAIL_WIDTH = 160  # ピクセル数
+
+STORAGE_FILE = "file"
+STORAGE_MEMORY = "memory"
+STORAGE_MMAP = "mmap"
+STORAGE_LIST = [STORAGE_FILE, STORAGE_MEMORY, STORAGE_MMAP]
+
+STORAGE_BYTE_BUDGET = 20 * 1024 * 1024 * 1024  # バイト数。録画ファイル(リングを含む)に使う容量の上限
+DISK_FREE_MARGIN = 1024 * 1024 * 1024  # バイト数。録画を始める時点でディスクに残しておく空き容量
 
 VIDEO_FOLDER_PATH = "./tmp_video/"
 VIDEO_NAME_PREFIX = "output"
-VIDEO_NAME_EXTENSION = ".mp4"
+MMAP_RING_FILE_PATH = VIDEO_FOLDER_PATH + "ring.raw"
+
+RECORDING_MODE_THREAD = "thread"
+RECORDING_MODE_PROCESS = "process"  # 読み込みと書き込みを別プロセスで行う。メモリ保存の場合はthreadで動作する
+RECORDING_MODE_LIST = [RECORDING_MODE_THREAD, RECORDING_MODE_PROCESS]
 
 
 class Model(object):
@@ -43,6 +95,9 @@ class Model(object):
         length: tk.IntVar
         auto_restart: tk.IntVar
         recording_preview: tk.BooleanVar
+        storage: tk.StringVar
+        codec: tk.StringVar
+        recording_mode: tk.StringVar
 
     @dataclass
     class UserSettings(object):
@@ -55,12 +110,19 @@ class Model(object):
         replay_time: int
         auto_restart: int
         recording_preview: bool
+        storage: str
+        codec: str
+        recording_mode: str
 
     @dataclass
     class RingVideoWriterSetting(object):
         fmt: cv2.VideoWriter_fourcc
         file_length_max: int
         buffer_size_max: int
+        overflow_policy: OverflowPolicy
+        keyframe_interval: int
+        byte_budget: int  # ファイル保存の場合にセグメントの合計サイズをこれ以下に抑える
+        proxy_width: Optional[int]  # フレーム間圧縮のコーデックの場合だけプロキシを書き込む
 
 
 class ModeState(Enum):
@@ -70,15 +132,12 @@ class ModeState(Enum):
 
 
 @contextmanager
-def open_cv2VideoCapture(device_num: int, width: int, height: int) -> cv2.VideoCapture:
-    capture = cv2.VideoCapture(device_num, cv2.CAP_DSHOW)
-    if capture.isOpened():
-        capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+def open_FrameSource(source: FrameSource) -> FrameSource:
+    if source.is_opened():
         try:
-            yield capture
+            yield source
         finally:
-            capture.release()
+            source.release()
 
 
 @contextmanager
@@ -90,63 +149,105 @@ def open_RingVideoCapture(file_list: List[str]) -> RingVideoCapture:
         player.release()
 
 
-@contextmanager
-def open_RingVideoWriter(
-    file_list: List[str],
-    user_settings: Model.UserSettings,
-    writer_settins: Model.RingVideoWriterSetting,
-    file_list_callback: Callable[[List[str]], None],
-) -> RingVideoWriter:
-    writer = RingVideoWriter(
-        file_list,
-        writer_settins.fmt,
-        user_settings.frame_rate,
-        (user_settings.width, user_settings.height),
-        writer_settins.file_length_max,
-        writer_settins.buffer_size_max,
-    )
-    try:
-        yield writer
-    finally:
-        files = writer.release()
-        file_list_callback(files)
+def to_photo_image(image: cv2.Mat) -> ttk.PhotoImage:
+    # PPMに変換してtkinterで表示できる画像にする
+    return ttk.PhotoImage(data=cv2.imencode(".ppm", image)[1].tobytes())
+
+
+@dataclass
+class DisplayStats(object):
+    shown_frame_num: int
+    coalesced_frame_num: int  # 表示される前に新しいフレームに置き換えられたフレーム数
+    latency_ms_average: float  # set_frameからimshowまでの時間
+    latency_ms_max: float
 
 
 class Cv2Display(object):
-    # cv2.imshowはメインスレッドでないと動作しないため、
-    # 描写関数をtkinter.Window.afterに登録し、メインスレッドで実行する
-    def __init__(self, root: ttk.Window, window_name: str):
+    """
+    cv2.imshowはメインスレッドでないと動作しないため、
+    描写関数をtkinter.Window.afterに登録し、メインスレッドで実行する。
+    フレームは1枚分だけ保持し、表示される前に次のフレームが来た場合は新しいフレームで置き換える。
+    preview_width_maxを指定した場合は、set_frameを呼んだスレッドで縮小してから渡す。
+    """
+
+    def __init__(
+        self,
+        root: ttk.Window,
+        window_name: str,
+        fps_max: int = PREVIEW_FPS_MAX,
+        preview_width_max: Optional[int] = None,
+    ):
         self.window_name = window_name
-        self.queue = Queue()
         self.root = root
         self.id = None
+        self.interval = max(1, 1000 // fps_max)  # ミリ秒
+        self.preview_width_max = preview_width_max
+        self._lock = Lock()
+        self._frame: Optional[Union[cv2.Mat, PooledFrame]] = None
+        self._frame_time = 0.0
+        self._shown_frame_num = 0
+        self._coalesced_frame_num = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
 
     def is_working(self) -> None:
         return self.id is not None
 
     def start(self) -> None:
-        self.id = self.root.after(5, self.show)
+        if not self.is_working():
+            self.id = self.root.after(self.interval, self.show)
 
     def stop(self) -> None:
         if self.is_working():
             self.root.after_cancel(self.id)
             self.id = None
+            # 表示されなかったフレームをプールに返す
+            release_frame(self._take_frame()[0])
             self.root.after(5, self.close_window)
 
-    def set_frame(self, frame: cv2.Mat) -> None:
-        if self.is_working():
-            self.queue.put_nowait(frame)
+    def set_frame(self, frame: Union[cv2.Mat, PooledFrame]) -> None:
+        if not self.is_working():
+            return
+        image = as_image(frame)
+        if self.preview_width_max is not None and image.shape[1] > self.preview_width_max:
+            # 縮小した場合は新しい配列になるため元のフレームは保持しなくてよい
+            height = image.shape[0] * self.preview_width_max // image.shape[1]
+            frame = cv2.resize(image, (self.preview_width_max, height), interpolation=cv2.INTER_AREA)
+        else:
+            retain_frame(frame)
+        with self._lock:
+            old_frame = self._frame
+            self._frame = frame
+            self._frame_time = perf_counter()
+            if old_frame is not None:
+                self._coalesced_frame_num += 1
+        release_frame(old_frame)
+
+    def get_stats(self) -> DisplayStats:
+        with self._lock:
+            latency_average = self._latency_sum / self._shown_frame_num if self._shown_frame_num > 0 else 0.0
+            return DisplayStats(
+                self._shown_frame_num, self._coalesced_frame_num, latency_average * 1000, self._latency_max * 1000
+            )
+
+    def _take_frame(self) -> Tuple[Optional[Union[cv2.Mat, PooledFrame]], float]:
+        with self._lock:
+            frame = self._frame
+            self._frame = None
+            return frame, self._frame_time
 
     def show(self) -> None:
-        try:
-            while True:
-                frame = self.queue.get_nowait()
-                cv2.imshow(self.window_name, frame)
-                cv2.waitKey(1)
-        except:
-            # 描写するフレームがない場合
-            pass
-        self.id = self.root.after(5, self.show)
+        frame, frame_time = self._take_frame()
+        if frame is not None:
+            cv2.imshow(self.window_name, as_image(frame))
+            release_frame(frame)
+            cv2.waitKey(1)
+            latency = perf_counter() - frame_time
+            with self._lock:
+                self._shown_frame_num += 1
+                self._latency_sum += latency
+                self._latency_max = max(self._latency_max, latency)
+        self.id = self.root.after(self.interval, self.show)
 
     def close_window(self) -> None:
         try:
@@ -184,103 +285,254 @@ class Repeater(object):
         self.id = self.root.after(self.repeatinterval, self._repeat_function)
 
 
+class ReplayerUiState(object):
+    """
+    再生用のスレッドから画面に反映したい状態を受け取っておく。
+    tkinterの変数やウィジェットはメインスレッドのafterで定期的にまとめて更新するため、
+    再生のフレームレートに関わらず画面の更新回数は一定になる。
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._frame: Optional[Tuple[int, float]] = None  # (フレーム番号, 時間)
+        self._is_play_stopped = False
+
+    def set_frame(self, frame_num: int, frame_time: float) -> None:
+        with self._lock:
+            self._frame = (frame_num, frame_time)
+
+    def set_play_stopped(self) -> None:
+        with self._lock:
+            self._is_play_stopped = True
+
+    def take(self) -> Tuple[Optional[Tuple[int, float]], bool]:
+        # 前回から変化した状態を返し、受け取った状態は消す
+        with self._lock:
+            frame, is_play_stopped = self._frame, self._is_play_stopped
+            self._frame = None
+            self._is_play_stopped = False
+        return frame, is_play_stopped
+
+
 class ReplayerModel(object):
+    """
+    キャプチャの操作はすべてFrameDecoderのスレッドで行い、ここではコマンドを積むだけにする。
+    コマ送りやシークで読み込んだフレームはデコーダのスレッドから表示する。
+    """
+
     def __init__(
         self,
-        file_list: List[str],
+        capture: Union[RingVideoCapture, FrameRingCapture],
         frame_rate: int,
         counter_callback: Callable[[int, float], None],
         display: Cv2Display,
         fast_diff: int,
+        prefetch_num: int = PREFETCH_BUFFER_SIZE,
     ):
         self.frame_rate = frame_rate
         self.counter_callback = lambda frame_num: counter_callback(frame_num, self.frame_to_time(frame_num))
-        self.capture = RingVideoCapture(file_list)
+        self.capture = capture
         self.fast_diff = fast_diff
         self.is_playing = False
         self.play_thread: Optional[Thread] = None
         self.display = display
-
-        self.play_stop: Thread = None
+        # プロキシがある場合はシーク、早送り中はプロキシを表示し、操作が止まってからマスターをデコードする
+        settle_time = PROXY_SETTLE_TIME if isinstance(capture, RingVideoCapture) and capture.has_proxy() else 0.0
+        self.decoder = FrameDecoder(capture, self._on_decoded_frame, prefetch_num, REVERSE_CHUNK_SIZE, settle_time)
+        self.origin_frame_num = capture.get_first_frame()  # frame_to_timeで0秒とするフレーム
+        # タイムシフト再生中は先頭のフレームが上書きされるため、タイムスタンプを控えておく
+        self._origin_timestamp = capture.get_timestamp(self.origin_frame_num)
+        self._play_session: Optional[int] = None
+        self.played_frame_num: Optional[int] = None  # 再生中に最後に表示したフレーム
+        self.speed = 1.0
+        self._clock: Optional[PlaybackClock] = None
+        self.play_stats = PlaybackStats()  # 直前または再生中の再生の統計
 
         self.to_last()
 
     def release(self) -> None:
-        self.capture.release()
+        # 再生用のスレッドが残らないように、再生を止めてからデコーダを閉じる
+        self.stop_play()
+        self.decoder.release()
+
+    def get_now_frame(self) -> int:
+        # 再生中はデコーダが先読みしているため、最後に表示したフレームを返す
+        played_frame_num = self.played_frame_num
+        if self.is_playing and played_frame_num is not None:
+            return played_frame_num
+        return self.decoder.get_now_frame()
+
+    def get_underrun_count(self) -> int:
+        # 再生中に先読みが間に合わなかった回数
+        return self.decoder.underrun_count
 
     def to_first(self) -> None:
-        self.capture.move_first()
-        self.prev_frame()
+        self.decoder.move_first()
 
     def to_last(self) -> None:
-        self.capture.move_last()
-        self.next_frame()
+        self.decoder.move_last()
 
     def next_frame(self) -> None:
-        frame = self.capture.read()
-        self.counter_callback(self.capture.get_now_frame())
-        if frame is not None:
-            self.display.set_frame(frame)
+        self.decoder.step(1)
 
     def prev_frame(self) -> None:
-        self.capture.move_diff(-2)
-        frame = self.capture.read()
-        self.counter_callback(self.capture.get_now_frame())
-        if frame is not None:
-            self.display.set_frame(frame)
+        self.decoder.step(-1)
 
     def fast_foward(self) -> None:
-        self.capture.move_diff(self.fast_diff - 1)
-        frame = self.capture.read()
-        self.counter_callback(self.capture.get_now_frame())
-        if frame is not None:
-            self.display.set_frame(frame)
+        self.decoder.step(self.fast_diff)
 
     def rewind(self) -> None:
-        self.capture.move_diff(-self.fast_diff - 1)
-        frame = self.capture.read()
-        self.counter_callback(self.capture.get_now_frame())
-        if frame is not None:
-            self.display.set_frame(frame)
+        self.decoder.step(-self.fast_diff)
 
     def move_to(self, frame_num: int) -> None:
-        self.capture.move_frame(frame_num)
-        frame = self.capture.read()
-        if frame is not None:
-            self.display.set_frame(frame)
+        # シークは最新の要求だけが実行される。カウンターはシークバー側で更新するため表示だけ行う
+        self.decoder.seek(frame_num)
 
-    def start_play(self, play_stop_callback: Callable[[None], None]) -> None:
+    def _on_decoded_frame(self, command: DecoderCommand, frame_num: int, frame: cv2.Mat, is_exact: bool) -> None:
+        self.display.set_frame(frame)
+        # シークバーの操作中にシークバーを動かさないように、シーク以外の場合だけカウンターを更新する。
+        # 早送り、早戻しではプロキシの近いフレームしか表示しないことがあるため、近いフレームでも更新する
+        if command != DecoderCommand.SEEK:
+            self.counter_callback(frame_num)
+
+    def start_play(self, play_stop_callback: Callable[[None], None], is_reverse: bool = False) -> None:
         if not self.is_playing:
             self.is_playing = True
-            self.play_thread = Thread(target=self._work_play, args=(play_stop_callback,))
+            self.played_frame_num = None
+            self._play_session = self.decoder.play(is_reverse)
+            # set_speedが再生用のスレッドの開始前に呼ばれても反映されるように、ここで作る
+            self._clock = PlaybackClock(self.frame_rate, self.speed)
+            self.play_thread = Thread(
+                target=self._work_play, args=(self._play_session, self._clock, play_stop_callback)
+            )
             self.play_thread.start()
 
     def stop_play(self) -> None:
+        if self._play_session is None:
+            return
         self.is_playing = False
-        if self.play_thread is not None:
-            self.play_thread = None
-
-    def _work_play(self, play_stop_callback: Callable[[None], None]) -> None:
-        start_time = time()
-        i = 1
-        counter = 0
-        while self.is_playing:
-            tmp = i / self.frame_rate
-            tmp_time = time()
-            if tmp_time < start_time + tmp:
-                counter += 1
-                sleep(start_time + tmp - tmp_time)
-            frame = self.capture.read()
-            self.counter_callback(self.capture.get_now_frame())
+        self._play_session = None
+        # 再生用のスレッドは表示の途中の可能性があるため待たない。表示時刻を待っている場合はすぐに戻す
+        clock = self._clock
+        if clock is not None:
+            clock.stop()
+        self.decoder.stop_play(self.played_frame_num)
+        self.play_thread = None
+
+    def set_speed(self, speed: float) -> None:
+        # 再生中に変更した場合はその時点の位置から新しい速度で進む
+        self.speed = speed
+        clock = self._clock
+        if clock is not None:
+            clock.set_speed(speed)
+
+    def _work_play(self, session: int, clock: PlaybackClock, play_stop_callback: Callable[[None], None]) -> None:
+        """
+        PlaybackClockで決まる時刻にフレームを表示する。表示する時刻は録画時のタイムスタンプの間隔から決める。
+        予定より遅れた場合は、次のフレームの表示時刻も過ぎていれば先読み済みのフレームを飛ばして追いつき、
+        フレームが間に合わない場合は前のフレームを表示したままにする(低速再生では同じフレームを長く表示する)。
+        """
+        stats = PlaybackStats()
+        self.play_stats = stats
+        positions: Dict[int, float] = {}  # 直近のフレームの再生開始からの位置
+        last_frame_num: Optional[int] = None
+        pending_item: Optional[Tuple[int, Optional[cv2.Mat]]] = None
+
+        def get_position(frame_num: int) -> float:
+            # 再生開始からの位置(フレーム数)。フレームの間隔を積み上げるため、逆再生の場合も正の値になる
+            nonlocal last_frame_num
+            if frame_num not in positions:
+                step = 1 if frame_num > last_frame_num else -1
+                position = positions[last_frame_num]
+                for n in range(last_frame_num, frame_num, step):
+                    position += self.get_play_interval(n, n + step) * self.frame_rate
+                positions[frame_num] = position
+                last_frame_num = frame_num
+                # 再生は一方向に進むため、直前のフレームより古い位置は使わない
+                for old_frame_num in [n for n in positions if abs(n - frame_num) > 1]:
+                    del positions[old_frame_num]
+            return positions[frame_num]
+
+        while self.is_playing and self._play_session == session:
+            item = pending_item if pending_item is not None else self.decoder.get(session)
+            pending_item = None
+            if item is None:
+                if not self.decoder.is_session_active(session):
+                    # 再生が止められた、またはデコーダが閉じられた
+                    break
+                # 先読みが間に合っていない
+                stats.underrun_num += 1
+                continue
+            if last_frame_num is None:
+                last_frame_num = item[0]
+                positions[last_frame_num] = 0.0
+
+            while item[1] is not None and clock.get_lateness(get_position(item[0])) > 0:
+                next_item = self.decoder.poll(session)
+                if next_item is None:
+                    break
+                if next_item[1] is None or clock.get_lateness(get_position(next_item[0])) < 0:
+                    pending_item = next_item
+                    break
+                item = next_item
+                stats.skipped_frame_num += 1
+
+            frame_num, frame = item
+            position = get_position(frame_num)
+            if not clock.wait(position) or self._play_session != session:
+                break
+            lateness = clock.get_lateness(position)
+            if lateness * self.frame_rate * self.speed >= 1:
+                stats.late_frame_num += 1
+            stats.lateness_ms_max = max(stats.lateness_ms_max, lateness * 1000)
+            self.counter_callback(frame_num)
             if frame is not None:
                 self.display.set_frame(frame)
+                self.played_frame_num = frame_num
+                stats.shown_frame_num += 1
             else:
-                self.is_playing = False
-            i += 1
-        play_stop_callback()
+                self.stop_play()
+        # 次の再生が始まっている場合は、そちらのPlaybackClockを残す
+        if self._clock is clock:
+            self._clock = None
+        if self._play_session in (session, None):
+            play_stop_callback()
+
+    def get_timestamp(self, frame_num: int) -> Optional[float]:
+        return self.capture.get_timestamp(frame_num)
+
+    def get_time_between(self, start_frame_num: int, end_frame_num: int) -> float:
+        # 2つのフレームの録画時刻の差[s]。タイムスタンプが無い場合は設定のフレームレートから計算する
+        start_time = self.get_timestamp(start_frame_num)
+        end_time = self.get_timestamp(end_frame_num)
+        if start_time is None or end_time is None:
+            return (end_frame_num - start_frame_num) / self.frame_rate
+        return end_time - start_time
+
+    def get_play_interval(self, frame_num: int, next_frame_num: int) -> float:
+        # 隣り合う2つのフレームを再生するときの間隔[s]。録画を止めていた間などの不連続な間隔はPLAY_GAP_MAXフレーム分に縮める
+        return min(abs(self.get_time_between(frame_num, next_frame_num)), PLAY_GAP_MAX / self.frame_rate)
+
+    def get_missing_frame_num(self, start_frame_num: int, end_frame_num: int) -> int:
+        # 2つのフレームの間で、録画時刻の間隔から推定した落ちたフレーム数。不連続な間隔は落ちたフレームに数えない
+        frame_num = abs(end_frame_num - start_frame_num)
+        expected_frame_num = round(abs(self.get_time_between(start_frame_num, end_frame_num)) * self.frame_rate)
+        if expected_frame_num <= frame_num:
+            return 0
+        step = 1 if end_frame_num > start_frame_num else -1
+        missing_frame_num = 0
+        for n in range(start_frame_num, end_frame_num, step):
+            interval_frame_num = round(abs(self.get_time_between(n, n + step)) * self.frame_rate)
+            if interval_frame_num <= PLAY_GAP_MAX:
+                missing_frame_num += max(0, interval_frame_num - 1)
+        return missing_frame_num
 
     def frame_to_time(self, frame_counter: int) -> float:
-        return round((frame_counter) / self.frame_rate, 3)
+        # 先頭のフレームからの時間
+        timestamp = self.get_timestamp(frame_counter)
+        if timestamp is None or self._origin_timestamp is None:
+            return round((frame_counter - self.origin_frame_num) / self.frame_rate, 3)
+        return round(timestamp - self._origin_timestamp, 3)
 
 
 class RecorderModel(object):
@@ -290,52 +542,164 @@ class RecorderModel(object):
         user_settings: Model.UserSettings,
         writer_settings: Model.RingVideoWriterSetting,
         display: Cv2Display,
+        frame_source_factory: Optional[Callable[[], FrameSource]] = None,
     ):
         self.file_list = [file for file in file_list]
         self.user_settings = user_settings
         self.writer_settings = writer_settings
+        self.frame_source_factory = frame_source_factory
         self.is_recording = False
+        self.is_preview = True
         self._recording_thread: Optional[Thread] = None
         self.display = display
+        self._writer: Optional[Union[RingVideoWriter, FrameRingWriter]] = None
+        self.frame_pool = FramePool(FRAME_POOL_SIZE)
+        self._dropped_frame_num = 0  # 終了した録画で捨てたフレーム数の合計
+        self._recording_process: Optional[RecordingProcess] = None
+        self.storage_planner = StoragePlanner(
+            writer_settings.byte_budget, len(file_list), writer_settings.file_length_max
+        )
+        # フレームの通し番号(リングの場合はseq)をキーにしたシークバー用のサムネイル。
+        # 前の録画のセグメントもリプレイに含まれるため、通し番号は録画をまたいで続けて振る(_frame_offset)
+        self._frame_offset = 0
+        self.thumbnail_index = ThumbnailIndex(
+            THUMBNAIL_INTERVAL,
+            THUMBNAIL_WIDTH,
+            user_settings.frame_rate * user_settings.replay_time // THUMBNAIL_INTERVAL + 2,
+        )
+
+        # メモリ保存、メモリマップ保存の場合はリングを録画をまたいで使いまわす
+        self.ring: Optional[Union[JpegFrameRing, MmapFrameRing]] = None
+        frame_num_max = user_settings.frame_rate * user_settings.replay_time
+        if user_settings.storage == STORAGE_MEMORY:
+            self.ring = JpegFrameRing(frame_num_max, MEMORY_JPEG_QUALITY)
+        elif user_settings.storage == STORAGE_MMAP:
+            self.ring = MmapFrameRing(MMAP_RING_FILE_PATH, frame_num_max, (user_settings.width, user_settings.height))
 
     def get_file_list(self) -> List[str]:
         return self.file_list
 
+    def create_capture(self, is_live: bool = False) -> Union[RingVideoCapture, FrameRingCapture]:
+        # 録画したリプレイを読み込むためのキャプチャを作成する
+        # is_live=Trueの場合は録画を続けたまま読み込めるキャプチャを作成する
+        if self.ring is not None:
+            return FrameRingCapture(self.ring, is_live)
+        return RingVideoCapture(self.file_list, DECODE_CACHE_SIZE, self.user_settings.replay_time, use_proxy=True)
+
+    def get_dropped_frame_num(self) -> int:
+        # 書き込みが間に合わずに捨てたフレーム数
+        if self._writer is not None:
+            return self._dropped_frame_num + self._writer.get_dropped_frame_num()
+        if self._recording_process is not None:
+            return self._dropped_frame_num + self._recording_process.dropped_frame_num
+        return self._dropped_frame_num
+
+    def is_timeshift_supported(self) -> bool:
+        # ファイル保存の場合は書き込み中のファイルを読み込めないためタイムシフト再生できない
+        return self.ring is not None
+
+    def set_preview(self, is_preview: bool) -> None:
+        # タイムシフト再生中は録画中の映像をプレビューに表示しない
+        self.is_preview = is_preview
+        if self._recording_process is not None:
+            self._recording_process.set_preview(is_preview)
+        if is_preview and self.user_settings.recording_preview is False:
+            self.display.stop()
+        else:
+            self.display.start()
+
     def get_frame_rate(self) -> int:
         return self.user_settings.frame_rate
 
+    def is_process_mode(self) -> bool:
+        # JpegFrameRingはプロセス間で共有できないため、メモリ保存の場合はスレッドで録画する
+        return self.user_settings.recording_mode == RECORDING_MODE_PROCESS and not isinstance(self.ring, JpegFrameRing)
+
     def start(self) -> None:
         if not self.is_recording:
             if self.user_settings.recording_preview is False:
                 self.display.stop()
             self.is_recording = True
-            self._recording_thread = Thread(target=self._work_recording)
-            self._recording_thread.start()
+            self.is_preview = True
+            if self.is_process_mode():
+                self._recording_process = RecordingProcess(
+                    self.create_recording_settings(),
+                    self.display.set_frame,
+                    self.frame_source_factory,
+                    self.thumbnail_index.put,
+                )
+            else:
+                self._recording_thread = Thread(target=self._work_recording)
+                self._recording_thread.start()
 
     def stop(self) -> None:
         if self.is_recording:
             self.is_recording = False
-            while self._recording_thread.is_alive():
-                sleep(0.1)
-            self._recording_thread = None
+            if self._recording_process is not None:
+                self.file_list = self._recording_process.stop()
+                self._dropped_frame_num += self._recording_process.dropped_frame_num
+                self._frame_offset = self._recording_process.next_frame_num
+                self._recording_process = None
+            else:
+                while self._recording_thread.is_alive():
+                    sleep(0.1)
+                self._recording_thread = None
             self.display.start()
 
+    def create_recording_settings(self) -> RecordingProcessSettings:
+        return RecordingProcessSettings(
+            device_num=self.user_settings.device_num,
+            width=self.user_settings.width,
+            height=self.user_settings.height,
+            frame_rate=self.user_settings.frame_rate,
+            file_list=self.file_list,
+            fmt=self.writer_settings.fmt,
+            file_length_max=self.writer_settings.file_length_max,
+            buffer_size_max=self.writer_settings.buffer_size_max,
+            overflow_policy=self.writer_settings.overflow_policy,
+            keyframe_interval=self.writer_settings.keyframe_interval,
+            byte_budget=self.writer_settings.byte_budget,
+            proxy_width=self.writer_settings.proxy_width,
+            thumbnail_interval=self.thumbnail_index.interval,
+            thumbnail_width=self.thumbnail_index.width,
+            frame_offset=self._frame_offset,
+            mmap_path=self.ring.get_file_path() if isinstance(self.ring, MmapFrameRing) else None,
+        )
+
+    def create_frame_source(self) -> FrameSource:
+        # 入力元の指定がない場合は設定された入力デバイスを使う
+        if self.frame_source_factory is not None:
+            return self.frame_source_factory()
+        return DeviceFrameSource(self.user_settings.device_num, self.user_settings.width, self.user_settings.height)
+
     def _work_recording(self) -> None:
-        with open_cv2VideoCapture(
-            self.user_settings.device_num, self.user_settings.width, self.user_settings.height
-        ) as capture:
-            writer = RingVideoWriter
-            with open_RingVideoWriter(
-                self.file_list, self.user_settings, self.writer_settings, self.update_file_list
-            ) as writer:
-                while self.is_recording:
-                    _, frame = capture.read()
-                    if frame is not None:
-                        writer.write(frame)
-                        self.display.set_frame(frame)
-
-    def update_file_list(self, file_list: List[str]) -> None:
-        self.file_list = file_list
+        with open_FrameSource(self.create_frame_source()) as source:
+            writer = create_writer(
+                self.create_recording_settings(), self.storage_planner, self.thumbnail_index.add_frame, self.ring
+            )
+            self._writer = writer
+            try:
+                run_recording(source, writer, self.frame_pool, lambda: self.is_recording, self._on_recorded_frame)
+            finally:
+                self._writer = None
+                result = writer.release()
+                self._dropped_frame_num += writer.get_dropped_frame_num()
+                if isinstance(writer, RingVideoWriter):
+                    self.file_list = result
+                    # 次の録画は続きの通し番号から書き込む
+                    self._frame_offset = writer.get_next_frame_num()
+
+    def _on_recorded_frame(self, pooled_frame: PooledFrame) -> None:
+        if self.is_preview:
+            self.display.set_frame(pooled_frame)
+
+    def get_retainable_length(self) -> float:
+        # 容量の制限で保持できるリプレイの長さ[s]。設定のリプレイ時間より長くはならない
+        if self.ring is not None:
+            return self.user_settings.replay_time
+        if self._recording_process is not None and self._recording_process.retainable_length is not None:
+            return min(self.user_settings.replay_time, self._recording_process.retainable_length)
+        return min(self.user_settings.replay_time, self.storage_planner.get_retainable_length())
 
 
 class _ControllerBase(object):
@@ -408,7 +772,12 @@ class _SettingController(_ControllerBase):
             tk.StringVar(self.root), tk.StringVar(self.root), tk.IntVar(self.root)
         )
         self.setting_replay = Model.VarSettingReplay(
-            tk.IntVar(self.root), tk.IntVar(self.root), tk.BooleanVar(self.root)
+            tk.IntVar(self.root),
+            tk.IntVar(self.root),
+            tk.BooleanVar(self.root),
+            tk.StringVar(self.root),
+            tk.StringVar(self.root),
+            tk.StringVar(self.root),
         )
 
         self.view.webcam_select.configure(textvariable=self.setting_webcamera.input_device)
@@ -416,6 +785,11 @@ class _SettingController(_ControllerBase):
         self.view.webcam_framerate.configure(textvariable=self.setting_webcamera.frame_rate)
         self.view.replay_length.configure(textvariable=self.setting_replay.length)
         self.view.replay_auto_restart.configure(textvariable=self.setting_replay.auto_restart)
+        self.view.replay_storage.configure(textvariable=self.setting_replay.storage, values=STORAGE_LIST)
+        self.view.replay_codec.configure(textvariable=self.setting_replay.codec, values=CODEC_LIST)
+        self.view.replay_recording_mode.configure(
+            textvariable=self.setting_replay.recording_mode, values=RECORDING_MODE_LIST
+        )
 
         self.view.webcam_select.configure(values=[device.name for device in self.capture_devices])
         self.view.webcam_select.bind("<<ComboboxSelected>>", self.on_change_device)
@@ -460,6 +834,14 @@ class _SettingController(_ControllerBase):
         tkvar_from_dict(json_data["webcamera"], self.setting_webcamera)
         tkvar_from_dict(json_data["replay"], self.setting_replay)
 
+        # 保存方式が未設定の古い設定ファイルの場合はファイル保存にする
+        if self.setting_replay.storage.get() not in STORAGE_LIST:
+            self.setting_replay.storage.set(STORAGE_FILE)
+        if self.setting_replay.codec.get() not in CODEC_LIST:
+            self.setting_replay.codec.set(DEFAULT_CODEC)
+        if self.setting_replay.recording_mode.get() not in RECORDING_MODE_LIST:
+            self.setting_replay.recording_mode.set(RECORDING_MODE_THREAD)
+
         self.on_change_device(None)
         # on_change_recording_preveiwを実行すると値が反転してしまうため予め逆にしておく
         self.setting_replay.recording_preview.set(not self.setting_replay.recording_preview.get())
@@ -510,6 +892,9 @@ class _SettingController(_ControllerBase):
         replay_time = self.setting_replay.length.get()
         auto_restart = self.setting_replay.auto_restart.get()
         recording_preview = self.setting_replay.recording_preview.get()
+        storage = self.setting_replay.storage.get()
+        codec = self.setting_replay.codec.get()
+        recording_mode = self.setting_replay.recording_mode.get()
 
         setting = Model.UserSettings(
             device_name=device_name,
@@ -520,6 +905,9 @@ class _SettingController(_ControllerBase):
             replay_time=replay_time,
             auto_restart=auto_restart,
             recording_preview=recording_preview,
+            storage=storage,
+            codec=codec,
+            recording_mode=recording_mode,
         )
 
         # print(f"カメラ名　　　　: {setting.device_name}")
@@ -553,6 +941,9 @@ class _ReplayerController(_ControllerBase):
     REPEAT_INTERVAL_FAST = 50
     REPEAT_INTERVAL = 85
     FAST_MOVE_FRAME = 20
+    TIMESHIFT_UPDATE_INTERVAL = 200
+    UI_UPDATE_INTERVAL = 33  # ミリ秒。再生中のフレームカウンターやシークバーを更新する間隔
+    RECORDING_LABEL_UPDATE_INTERVAL = 500
 
     def __init__(self, root: ttk.Window):
         self.root = root
@@ -561,7 +952,17 @@ class _ReplayerController(_ControllerBase):
         self.var_seekbar = tk.IntVar()
         self.var_frame_counter = tk.StringVar(value="FRAME COUNTER(from the point)")
         self.view.seekbar.configure(variable=self.var_seekbar, command=self.on_seekbar_change)
+        self.view.seekbar.bind("<ButtonPress-1>", self.on_seekbar_press)
+        self.view.seekbar.bind("<ButtonRelease-1>", self.on_seekbar_release)
+        self._is_seekbar_dragging = False
+        # PhotoImageは参照が無くなると表示が消えるため保持しておく
+        self._thumbnail_cursor_image: Optional[ttk.PhotoImage] = None
+        self._thumbnail_strip_image: Optional[ttk.PhotoImage] = None
+        self._thumbnail_strip_range: Optional[Tuple[int, int]] = None
         self.view.counter_label.configure(textvariable=self.var_frame_counter)
+        self.var_speed = tk.StringVar(value=DEFAULT_PLAYBACK_SPEED)
+        self.view.speed_select.configure(textvariable=self.var_speed, values=PLAYBACK_SPEED_LIST)
+        self.view.speed_select.bind("<<ComboboxSelected>>", self.on_change_speed)
 
         # ボタンを押しっぱなしのときに繰り返し実行するためのリピーターをかませる。
         self.repeat_rewind = Repeater(self.root, self.press_rewind, self.REPEAT_DELAY, self.REPEAT_INTERVAL_FAST)
@@ -582,15 +983,24 @@ class _ReplayerController(_ControllerBase):
         self.view.button_next.bind("<ButtonRelease>", self.repeat_next.cancel)
 
         self.view.button_set_point.configure(command=self.press_set_point)
+        self.view.button_timeshift.configure(command=self.start_timeshift)
 
-        self.display = Cv2Display(self.root, "Quick Replayer View")
+        self.display = Cv2Display(self.root, "Quick Replayer View", PREVIEW_FPS_MAX, PREVIEW_WIDTH_MAX)
         self.display.start()
 
+        # 再生用のスレッドからは直接画面を更新せず、ここに状態を渡してメインスレッドで反映する
+        self.ui_state = ReplayerUiState()
+        self.root.after(self.UI_UPDATE_INTERVAL, self._apply_ui_state)
+
         self.replayer: Optional[ReplayerModel] = None
         self.recorder: Optional[RecorderModel] = None
 
         self.origin_point_frame_num: Optional[int] = None
 
+        self.is_timeshift = False
+        self._timeshift_update_id = None
+        self._recording_label_update_id = None
+
     def enable(self) -> None:
         self.view.enable()
         self._play_stop_callback()
@@ -614,49 +1024,144 @@ class _ReplayerController(_ControllerBase):
         self.mode = ModeState.RECORDING
         self.change_widget_state_for_recording(False)
         self.view.button_recording.configure(image=self.view.icon_stop, command=self.stop_recording, bootstyle="danger")
-        self.view.seekbar_right_label.configure(text="Recording")
         self.view.seekbar.configure(from_=-1, to=0, value=0, state="disable")
+        self.clear_thumbnail_strip()
+        self.view.button_timeshift.configure(
+            text="Time shift",
+            command=self.start_timeshift,
+            state="enable" if self.recorder.is_timeshift_supported() else "disable",
+        )
         self.reset_frame_counter()
         self.recorder.start()
+        self._update_recording_label()
 
     def stop_recording(self) -> None:
-        if self.mode != ModeState.RECORDING:
+        if self.recorder is None or not self.recorder.is_recording:
             return
+        self.stop_timeshift()
+        self._cancel_recording_label_update()
         self.recorder.stop()
+        self.view.button_timeshift.configure(state="disable")
 
-        self.replayer = ReplayerModel(
-            self.recorder.get_file_list(),
-            self.recorder.get_frame_rate(),
-            self.frame_update_callback,
-            self.display,
-            self.FAST_MOVE_FRAME,
-        )
+        self.replayer = self.create_replayer(self.recorder.create_capture())
 
         self.change_widget_state_for_recording(True)
         frame_num = self.replayer.capture.get_frame_num() - 1
         self.view.seekbar.config(from_=0, to=frame_num, state="enable")
         self.var_seekbar.set(frame_num)
+        self.update_thumbnail_strip()
         self.view.button_recording.configure(
             image=self.view.icon_record, command=self.start_recording, bootstyle="danger"
         )
         self.pause()
 
+    def create_replayer(self, capture: Union[RingVideoCapture, FrameRingCapture]) -> ReplayerModel:
+        replayer = ReplayerModel(
+            capture, self.recorder.get_frame_rate(), self.ui_state.set_frame, self.display, self.FAST_MOVE_FRAME
+        )
+        replayer.set_speed(self.get_speed())
+        return replayer
+
+    def get_speed(self) -> float:
+        return float(self.var_speed.get().rstrip("x"))
+
+    def on_change_speed(self, event=None) -> None:  # NOQA
+        if self.replayer is not None:
+            self.replayer.set_speed(self.get_speed())
+
     def change_widget_state_for_recording(self, is_enabled: bool) -> None:
         state = "enable" if is_enabled else "disable"
         self.view.button_rewind.configure(state=state)
         self.view.button_prev.configure(state=state)
+        self.view.button_reverse_play.configure(state=state)
         self.view.button_play.configure(state=state)
         self.view.button_next.configure(state=state)
         self.view.button_forward.configure(state=state)
         self.view.button_set_point.configure(state=state)
 
+    def start_timeshift(self) -> None:
+        # 録画を続けたまま直近の映像をリプレイする
+        if self.is_timeshift or self.recorder is None or not self.recorder.is_recording:
+            return
+        if not self.recorder.is_timeshift_supported():
+            return
+        self.is_timeshift = True
+        self._cancel_recording_label_update()
+        self.recorder.set_preview(False)
+        self.replayer = self.create_replayer(self.recorder.create_capture(is_live=True))
+        self.change_widget_state_for_recording(True)
+        self.view.seekbar.configure(state="enable")
+        self.view.button_timeshift.configure(text="Live", command=self.stop_timeshift)
+        self._update_timeshift_range()
+        self.var_seekbar.set(self.replayer.get_now_frame())
+        self._play_stop_callback()
+
+    def stop_timeshift(self) -> None:
+        # タイムシフト再生を終了して録画中の映像のプレビューに戻る
+        if not self.is_timeshift:
+            return
+        self.is_timeshift = False
+        if self._timeshift_update_id is not None:
+            self.root.after_cancel(self._timeshift_update_id)
+            self._timeshift_update_id = None
+        self.replayer.stop_play()
+        self.replayer.release()
+        self.replayer = None
+
+        self.mode = ModeState.RECORDING
+        self.change_widget_state_for_recording(False)
+        self.view.seekbar.configure(from_=-1, to=0, value=0, state="disable")
+        self.clear_thumbnail_strip()
+        self.view.button_timeshift.configure(text="Time shift", command=self.start_timeshift)
+        self.reset_frame_counter()
+        self.recorder.set_preview(True)
+        self._update_recording_label()
+
+    def _update_recording_label(self) -> None:
+        # 録画中は書き込みが間に合わずに捨てたフレーム数を表示する
+        # 容量の制限でリプレイ時間が設定より短くなる場合はその長さも表示する
+        infomations = []
+        dropped_frame_num = self.recorder.get_dropped_frame_num()
+        if dropped_frame_num > 0:
+            infomations.append(f"drop: {dropped_frame_num}")
+        retainable_length = self.recorder.get_retainable_length()
+        if retainable_length < self.recorder.user_settings.replay_time:
+            infomations.append(f"replay: {retainable_length:.0f}s")
+        if len(infomations) > 0:
+            self.view.seekbar_right_label.configure(text=f"Recording ({', '.join(infomations)})")
+        else:
+            self.view.seekbar_right_label.configure(text="Recording")
+        self._recording_label_update_id = self.root.after(
+            self.RECORDING_LABEL_UPDATE_INTERVAL, self._update_recording_label
+        )
+
+    def _cancel_recording_label_update(self) -> None:
+        if self._recording_label_update_id is not None:
+            self.root.after_cancel(self._recording_label_update_id)
+            self._recording_label_update_id = None
+
+    def _update_timeshift_range(self) -> None:
+        # 録画が進むのに合わせてシークバーの範囲を更新する
+        capture = self.replayer.capture
+        self.view.seekbar.configure(from_=capture.get_first_frame(), to=max(0, capture.get_frame_num() - 1))
+        self.update_thumbnail_strip()
+        self._timeshift_update_id = self.root.after(self.TIMESHIFT_UPDATE_INTERVAL, self._update_timeshift_range)
+
     def play(self) -> None:
         if self.replayer is None:
             return
         self.mode = ModeState.PLAY
         self.view.button_play.configure(image=self.view.icon_pause, command=self.pause, bootstyle="warning")
-        self.replayer.start_play(self._play_stop_callback)
-        pass
+        self.view.button_reverse_play.configure(command=self.pause)
+        self.replayer.start_play(self.ui_state.set_play_stopped)
+
+    def play_reverse(self) -> None:
+        if self.replayer is None:
+            return
+        self.mode = ModeState.PLAY
+        self.view.button_reverse_play.configure(image=self.view.icon_pause, command=self.pause, bootstyle="warning")
+        self.view.button_play.configure(command=self.pause)
+        self.replayer.start_play(self.ui_state.set_play_stopped, is_reverse=True)
 
     def pause(self) -> None:
         if self.replayer is None:
@@ -666,6 +1171,9 @@ class _ReplayerController(_ControllerBase):
     def _play_stop_callback(self) -> None:
         self.mode = ModeState.PAUSE
         self.view.button_play.configure(image=self.view.icon_play, command=self.play, bootstyle="success")
+        self.view.button_reverse_play.configure(
+            image=self.view.icon_play_reverse, command=self.play_reverse, bootstyle="success"
+        )
 
     def press_rewind(self) -> None:
         # print("press_rewind")
@@ -703,7 +1211,7 @@ class _ReplayerController(_ControllerBase):
         # print("Set point")
         if self.replayer is None:
             return
-        now_frame = self.replayer.capture.get_now_frame()
+        now_frame = self.replayer.get_now_frame()
         self.origin_point_frame_num = now_frame
         self.update_frame_counter_label(now_frame)
 
@@ -714,16 +1222,30 @@ class _ReplayerController(_ControllerBase):
             return
         diff_frame = frame_num - self.origin_point_frame_num
 
+        # フレーム数ではなく録画時のタイムスタンプの差を表示する
+        diff_time = round(abs(self.replayer.get_time_between(self.origin_point_frame_num, frame_num)), 3)
         if diff_frame >= 0:
-            diff_time = self.replayer.frame_to_time(diff_frame)
             minute = diff_time // 60
             sec = diff_time % 60
         else:
-            diff_time = self.replayer.frame_to_time(-diff_frame)
             minute = -(diff_time // 60)
             sec = diff_time % 60
 
-        self.var_frame_counter.set(f"{minute:03.0f}:{sec:06.3f} ( {diff_frame:8d} frame )")
+        text = f"{minute:03.0f}:{sec:06.3f} ( {diff_frame:8d} frame )"
+        # 間でフレームが落ちている場合は落ちたフレーム数も表示する
+        missing_frame_num = self.replayer.get_missing_frame_num(self.origin_point_frame_num, frame_num)
+        if missing_frame_num > 0:
+            text += f" drop {missing_frame_num}"
+        self.var_frame_counter.set(text)
+
+    def _apply_ui_state(self) -> None:
+        frame, is_play_stopped = self.ui_state.take()
+        if frame is not None and self.replayer is not None:
+            self.frame_update_callback(*frame)
+        # 停止直後に再び再生を始めた場合はボタンを戻さない
+        if is_play_stopped and (self.replayer is None or not self.replayer.is_playing):
+            self._play_stop_callback()
+        self.root.after(self.UI_UPDATE_INTERVAL, self._apply_ui_state)
 
     def frame_update_callback(self, frame_num: int, frame_time: float) -> None:
         self.update_frame_counter_label(frame_num)
@@ -737,6 +1259,75 @@ class _ReplayerController(_ControllerBase):
         self.replayer.move_to(frame_num)
         self.update_frame_counter_label(frame_num)
         self.update_seekbar_label(self.replayer.frame_to_time(frame_num))
+        if self._is_seekbar_dragging:
+            self.show_thumbnail_cursor(frame_num)
+
+    def on_seekbar_press(self, event):  # NOQA
+        self._is_seekbar_dragging = True
+
+    def on_seekbar_release(self, event):  # NOQA
+        self._is_seekbar_dragging = False
+        self.view.thumbnail_cursor.place_forget()
+
+    def get_thumbnail(self, frame_num: int) -> Optional[cv2.Mat]:
+        # 録画中に作ったサムネイルから近いものを探す。デコードは行わない
+        if self.replayer is None or self.recorder is None:
+            return None
+        global_frame = self.replayer.capture.get_global_frame(frame_num)
+        if global_frame is None:
+            return None
+        return self.recorder.thumbnail_index.get_nearest(global_frame)
+
+    def show_thumbnail_cursor(self, frame_num: int) -> None:
+        # シークバーのつまみの真下にサムネイルを表示する
+        thumbnail = self.get_thumbnail(frame_num)
+        if thumbnail is None:
+            self.view.thumbnail_cursor.place_forget()
+            return
+        self._thumbnail_cursor_image = to_photo_image(thumbnail)
+        self.view.thumbnail_cursor.configure(image=self._thumbnail_cursor_image)
+
+        seekbar = self.view.seekbar
+        first, last = float(seekbar.cget("from")), float(seekbar.cget("to"))
+        ratio = (frame_num - first) / (last - first) if last > first else 0.0
+        x = seekbar.winfo_rootx() - self.view.frame_thumbnail.winfo_rootx() + ratio * seekbar.winfo_width()
+        x_max = max(0, self.view.frame_thumbnail.winfo_width() - thumbnail.shape[1])
+        self.view.thumbnail_cursor.place(x=min(max(0, int(x - thumbnail.shape[1] / 2)), x_max), y=0)
+
+    def update_thumbnail_strip(self) -> None:
+        # リプレイ全体を等間隔に分け、それぞれの位置に近いサムネイルをシークバーの幅に並べる
+        if self.replayer is None:
+            return
+        capture = self.replayer.capture
+        frame_range = (capture.get_first_frame(), capture.get_frame_num())
+        if frame_range == self._thumbnail_strip_range:
+            return
+        self._thumbnail_strip_range = frame_range
+        first, end = frame_range
+        slot_num = max(1, self.view.seekbar.winfo_width() // THUMBNAIL_WIDTH)
+        thumbnails = [
+            self.get_thumbnail(first + (end - first) * (2 * i + 1) // (2 * slot_num)) for i in range(slot_num)
+        ]
+        found = [thumbnail for thumbnail in thumbnails if thumbnail is not None]
+        if len(found) == 0:
+            self.clear_thumbnail_strip()
+            return
+        # サムネイルが無い位置は黒で埋める
+        blank = np.zeros_like(found[0])
+        strip = cv2.hconcat(
+            [
+                thumbnail if thumbnail is not None and thumbnail.shape == blank.shape else blank
+                for thumbnail in thumbnails
+            ]
+        )
+        self._thumbnail_strip_image = to_photo_image(strip)
+        self.view.thumbnail_strip.configure(image=self._thumbnail_strip_image)
+
+    def clear_thumbnail_strip(self) -> None:
+        self._thumbnail_strip_range = None
+        self._thumbnail_strip_image = None
+        self.view.thumbnail_strip.configure(image="")
+        self.view.thumbnail_cursor.place_forget()
 
     def update_seekbar_label(self, frame_time: float) -> None:
         minute = frame_time // 60
@@ -784,18 +1375,80 @@ class Controller(object):
         self.root.attributes("-topmost", True)
 
         user_setting = self._controller_setting.get_settings()
-        writer_setting = Model.RingVideoWriterSetting(FMT, FILE_LENGTH, WRITER_BUFFER_SIZE)
-
-        file_num = int(user_setting.replay_time / FILE_LENGTH) + 1
-        file_list = [f"{VIDEO_FOLDER_PATH}{VIDEO_NAME_PREFIX}{i}{VIDEO_NAME_EXTENSION}" for i in range(file_num)]
+        if user_setting.codec == CODEC_AUTO and user_setting.storage == STORAGE_FILE:
+            # 指定の解像度、フレームレートで書き込みが間に合うコーデックを選ぶ。
+            # コーデックごとに試しに書き込むため数秒かかる。画面が固まらないように別スレッドで行い、終わるのを待つ
+            result: List[Codec] = []
+            thread = Thread(
+                target=lambda: result.append(
+                    calibrate(
+                        user_setting.width,
+                        user_setting.height,
+                        user_setting.frame_rate,
+                        CALIBRATION_CPU_BUDGET,
+                        CALIBRATION_LENGTH,
+                    )
+                ),
+                daemon=True,
+            )
+            thread.start()
+            self._wait_calibration(thread, result, user_setting)
+        else:
+            self._start_replayer(user_setting, get_codec(user_setting.codec) or get_codec(DEFAULT_CODEC))
 
-        # 動画保存用フォルダを空にする
-        for file in file_list:
-            # print(file)
-            try:
-                os.remove(file)
-            except FileNotFoundError:
-                pass
+    def _wait_calibration(self, thread: Thread, result: List[Codec], user_setting: Model.UserSettings) -> None:
+        if thread.is_alive():
+            self.root.after(CALIBRATION_POLL_INTERVAL, self._wait_calibration, thread, result, user_setting)
+            return
+        self._start_replayer(user_setting, result[0] if len(result) > 0 else get_codec(DEFAULT_CODEC))
+
+    def _start_replayer(self, user_setting: Model.UserSettings, codec: Codec) -> None:
+        # リプレイ時間分のセグメントに加えて、書き込み中のセグメントと、
+        # 切り替えの前に開いておく(中身が消える)次のセグメントの分を用意する
+        file_num = math.ceil(user_setting.replay_time / FILE_LENGTH) + 2
+        file_list = [f"{VIDEO_FOLDER_PATH}{VIDEO_NAME_PREFIX}{i}{codec.extension}" for i in range(file_num)]
+
+        # 動画保存用フォルダを空にする(以前の設定のセグメントも含めて消す)
+        os.makedirs(VIDEO_FOLDER_PATH, exist_ok=True)
+        for file_name in os.listdir(VIDEO_FOLDER_PATH):
+            if file_name.startswith(VIDEO_NAME_PREFIX):
+                try:
+                    os.remove(os.path.join(VIDEO_FOLDER_PATH, file_name))
+                except FileNotFoundError:
+                    pass
+
+        # 以前のリングは、mmap保存の場合は上書きされるため空き容量に含め、それ以外の場合は使わないため消す
+        ring_byte_num = 0
+        if os.path.exists(MMAP_RING_FILE_PATH):
+            if user_setting.storage == STORAGE_MMAP:
+                ring_byte_num = os.path.getsize(MMAP_RING_FILE_PATH)
+            else:
+                os.remove(MMAP_RING_FILE_PATH)
+
+        # ディスクの空き容量を確認し、録画に使える容量を決める
+        free_byte_num = get_free_byte_num(VIDEO_FOLDER_PATH) + ring_byte_num
+        byte_budget = max(0, min(STORAGE_BYTE_BUDGET, free_byte_num - DISK_FREE_MARGIN))
+        if user_setting.storage == STORAGE_MMAP:
+            # 無圧縮のリングはサイズが決まっているため、収まらない場合はリプレイ時間を短くする
+            second_byte_num = MmapFrameRing.get_byte_num(
+                user_setting.frame_rate, (user_setting.width, user_setting.height)
+            )
+            user_setting.replay_time = max(1, min(user_setting.replay_time, byte_budget // second_byte_num))
+        elif user_setting.storage == STORAGE_MEMORY:
+            # JPEGのリングはメモリに置くため、メモリの上限に収まるようにリプレイ時間を短くする
+            second_byte_num = (
+                user_setting.width * user_setting.height * 3 * user_setting.frame_rate // MEMORY_JPEG_RATIO
+            )
+            user_setting.replay_time = max(1, min(user_setting.replay_time, MEMORY_BYTE_BUDGET // second_byte_num))
+        writer_setting = Model.RingVideoWriterSetting(
+            codec.get_fourcc(),
+            FILE_LENGTH,
+            WRITER_BUFFER_SIZE,
+            WRITER_OVERFLOW_POLICY,
+            codec.keyframe_interval,
+            byte_budget,
+            PROXY_WIDTH if codec.keyframe_interval > 1 else None,
+        )
 
         self._controller_replayer.initialize_writer(file_list, user_setting, writer_setting)
         self._error_label_input_device_error.pack_forget()
@@ -810,6 +1463,9 @@ class Controller(object):
 
 
 if __name__ == "__main__":
+    # exe化した場合に録画用の子プロセスが正しく起動するようにする
+    multiprocessing.freeze_support()
+
     root = ttk.Window(title="Quick Replay", themename="superhero", resizable=(False, False))
 
     controller = Controller(root)
@@ -74,6 +74,27 @@ class SettingView(ttk.Frame, _ViewBase):
 
         row += 1
 
+        self.replay_storage_label = ttk.Label(master=self.frame_setting, text="保存先")
+        self.replay_storage_label.grid(row=row, column=0, padx=5, pady=5)
+        self.replay_storage = ttk.Combobox(master=self.frame_setting, state="readonly")
+        self.replay_storage.grid(row=row, column=1, padx=5, pady=5, sticky=ttk.W + ttk.E)
+
+        row += 1
+
+        self.replay_codec_label = ttk.Label(master=self.frame_setting, text="コーデック")
+        self.replay_codec_label.grid(row=row, column=0, padx=5, pady=5)
+        self.replay_codec = ttk.Combobox(master=self.frame_setting, state="readonly")
+        self.replay_codec.grid(row=row, column=1, padx=5, pady=5, sticky=ttk.W + ttk.E)
+
+        row += 1
+
+        self.replay_recording_mode_label = ttk.Label(master=self.frame_setting, text="録画処理")
+        self.replay_recording_mode_label.grid(row=row, column=0, padx=5, pady=5)
+        self.replay_recording_mode = ttk.Combobox(master=self.frame_setting, state="readonly")
+        self.replay_recording_mode.grid(row=row, column=1, padx=5, pady=5, sticky=ttk.W + ttk.E)
+
+        row += 1
+
         self.recording_preview_label = ttk.Label(master=self.frame_setting, text="録画時プレビュー")
         self.recording_preview_label.grid(row=row, padx=5, pady=10)
 
@@ -132,7 +153,15 @@ class ReplayerView(ttk.Frame):
         self.seekbar_right_label = ttk.Label(master=self.frame_seekbar, text="0:00/ -0:00")
         self.seekbar_right_label.pack(padx=5, side=ttk.RIGHT)
 
+        # リプレイ全体のサムネイルの一覧。シークバーの操作中はカーソルの位置のサムネイルを上に重ねて表示する
+        self.frame_thumbnail = ttk.Frame(master=self)
+        self.frame_thumbnail.pack(padx=20, anchor=ttk.W, fill=ttk.X)
+        self.thumbnail_strip = ttk.Label(master=self.frame_thumbnail)
+        self.thumbnail_strip.pack(anchor=ttk.W)
+        self.thumbnail_cursor = ttk.Label(master=self.frame_thumbnail)
+
         self.icon_play = ttk.PhotoImage(file=r"./assets/play.png")
+        self.icon_play_reverse = ttk.PhotoImage(file=r"./assets/play_reverse.png")
         self.icon_pause = ttk.PhotoImage(file=r"./assets/pause.png")
         self.icon_next = ttk.PhotoImage(file=r"./assets/next.png")
         self.icon_prev = ttk.PhotoImage(file=r"./assets/prev.png")
@@ -148,6 +177,10 @@ class ReplayerView(ttk.Frame):
         self.button_rewind.pack(padx=self.CONTROL_BUTTON_CLEARANCE, pady=5, ipady=10, side=ttk.LEFT)
         self.button_prev = ttk.Button(master=self.frame_video_button, image=self.icon_prev, bootstyle="primary")
         self.button_prev.pack(padx=self.CONTROL_BUTTON_CLEARANCE, pady=5, ipady=10, side=ttk.LEFT, anchor=ttk.CENTER)
+        self.button_reverse_play = ttk.Button(
+            master=self.frame_video_button, image=self.icon_play_reverse, bootstyle="success"
+        )
+        self.button_reverse_play.pack(padx=self.CONTROL_BUTTON_CLEARANCE, pady=5, ipady=10, side=ttk.LEFT)
         self.button_play = ttk.Button(master=self.frame_video_button, image=self.icon_play, bootstyle="success")
         self.button_play.pack(padx=self.CONTROL_BUTTON_CLEARANCE, pady=5, ipady=10, side=ttk.LEFT)
         self.button_next = ttk.Button(master=self.frame_video_button, image=self.icon_next, bootstyle="primary")
@@ -168,13 +201,22 @@ class ReplayerView(ttk.Frame):
         self.button_set_point.pack(padx=20, pady=5, side=ttk.LEFT)
         self.counter_label = ttk.Label(master=self.frame_option_button, text="FRAME COUNTER(from point)")
         self.counter_label.pack(padx=20, pady=5, side=ttk.LEFT, fill=ttk.X)
+        self.button_timeshift = ttk.Button(
+            master=self.frame_option_button, text="Time shift", bootstyle="secondary", state="disable"
+        )
+        self.button_timeshift.pack(padx=20, pady=5, side=ttk.RIGHT)
+        self.speed_select = ttk.Combobox(master=self.frame_option_button, state="readonly", width=6)
+        self.speed_select.pack(padx=5, pady=5, side=ttk.RIGHT)
 
         ttk_tooltip.ToolTip(self.button_rewind, text="早戻し")
         ttk_tooltip.ToolTip(self.button_prev, text="1コマ戻る")
+        ttk_tooltip.ToolTip(self.button_reverse_play, text="逆再生")
         ttk_tooltip.ToolTip(self.button_play, text="再生")
         ttk_tooltip.ToolTip(self.button_next, text="1コマ進める")
         ttk_tooltip.ToolTip(self.button_forward, text="早送り")
         ttk_tooltip.ToolTip(self.button_set_point, text="タイマーの基点を設定")
+        ttk_tooltip.ToolTip(self.button_timeshift, text="録画を続けたままリプレイ")
+        ttk_tooltip.ToolTip(self.speed_select, text="再生速度")
 
     def enable(self) -> None:
         self.pack(padx=5, pady=5, fill=ttk.X)
@@ -0,0 +1,256 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+from dataclasses import dataclass
+from multiprocessing import Pipe, Process, shared_memory
+from multiprocessing.connection import Connection
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+from typing import Callable, List, Optional, Union
+
+import cv2
+import numpy as np
+
+from frame_pool import FramePool, PooledFrame
+from frame_source import DeviceFrameSource, FrameSource
+from ring_video import FrameRingWriter, JpegFrameRing, MmapFrameRing, OverflowPolicy, RingVideoWriter
+from storage_planner import SegmentInfo, StoragePlanner
+from thumbnail_index import make_thumbnail
+
+STATS_INTERVAL = 0.5  # 秒数。子プロセスから統計を送る間隔
+PREVIEW_HEADER_DTYPE = np.dtype("<i8")
+PREVIEW_HEADER_NUM = 2  # [書き込んだプレビューの番号, 読み込んだプレビューの番号]
+
+
+@dataclass
+class RecordingProcessSettings(object):
+    device_num: int
+    width: int
+    height: int
+    frame_rate: int
+    file_list: List[str]
+    fmt: int
+    file_length_max: int
+    buffer_size_max: int
+    overflow_policy: OverflowPolicy
+    keyframe_interval: int
+    byte_budget: int
+    proxy_width: Optional[int]
+    thumbnail_interval: int  # フレーム数。このフレームごとに縮小画像をUI側に送る
+    thumbnail_width: int
+    frame_offset: int  # ファイル保存の場合の最初のフレームの通し番号
+    mmap_path: Optional[str] = None  # 指定した場合はファイルではなくMmapFrameRingに書き込む
+
+
+def create_writer(
+    settings: RecordingProcessSettings,
+    planner: StoragePlanner,
+    thumbnail_callback: Callable[[int, cv2.Mat], None],
+    ring: Optional[Union[JpegFrameRing, MmapFrameRing]] = None,
+) -> Union[RingVideoWriter, FrameRingWriter]:
+    # スレッドでの録画と子プロセスでの録画で共通の書き込み先を作る。
+    # ringを指定せずにmmap_pathが指定されている場合は、子プロセスからMmapFrameRingを開いて書き込む
+    if ring is None and settings.mmap_path is not None:
+        ring = MmapFrameRing.attach(settings.mmap_path)
+    if ring is not None:
+        return FrameRingWriter(ring, settings.buffer_size_max, settings.overflow_policy, thumbnail_callback)
+
+    def on_segment_written(segment: SegmentInfo) -> None:
+        # 書き込みが終わったセグメントのサイズから、容量に収まるファイル数に減らす
+        planner.add_segment(segment)
+        writer.set_active_file_num(planner.get_file_num())
+
+    writer = RingVideoWriter(
+        settings.file_list,
+        settings.fmt,
+        settings.frame_rate,
+        (settings.width, settings.height),
+        settings.file_length_max,
+        settings.buffer_size_max,
+        settings.keyframe_interval,
+        overflow_policy=settings.overflow_policy,
+        segment_callback=on_segment_written,
+        proxy_width=settings.proxy_width,
+        thumbnail_callback=thumbnail_callback,
+        frame_offset=settings.frame_offset,
+    )
+    return writer
+
+
+def run_recording(
+    source: FrameSource,
+    writer: Union[RingVideoWriter, FrameRingWriter],
+    pool: FramePool,
+    is_running: Callable[[], bool],
+    frame_callback: Callable[[PooledFrame], None],
+) -> None:
+    # is_runningがFalseを返すまで入力元を読み込んで書き込む。スレッドでの録画と子プロセスでの録画で共通。
+    # frame_callbackには書き込んだフレームを渡す。呼び出しの後でプールに戻すため、保持する場合はretainする
+    while is_running():
+        # プールのバッファに読み込み、書き込みと表示が終わったらプールに戻す
+        pooled_frame = pool.acquire()
+        _, frame = source.read(pooled_frame.image)
+        # 書き込み待ちの時間を含めないように、読み込んだ直後の時刻をフレームの時刻にする
+        timestamp = monotonic()
+        if frame is not None:
+            pooled_frame.image = frame
+            writer.write(pooled_frame, timestamp)
+            frame_callback(pooled_frame)
+        pooled_frame.release()
+
+
+def _recording_process_main(
+    command_conn: Connection,
+    status_conn: Connection,
+    settings: RecordingProcessSettings,
+    shm_name: str,
+    frame_source_factory: Optional[Callable[[], FrameSource]],
+) -> None:
+    # 子プロセスで実行される。stopコマンドを受け取るまで入力デバイスを読み込んで書き込む
+    shm = shared_memory.SharedMemory(name=shm_name)
+    header = np.ndarray((PREVIEW_HEADER_NUM,), dtype=PREVIEW_HEADER_DTYPE, buffer=shm.buf)
+    preview = np.ndarray((settings.height, settings.width, 3), dtype=np.uint8, buffer=shm.buf, offset=header.nbytes)
+
+    if frame_source_factory is not None:
+        source = frame_source_factory()
+    else:
+        source = DeviceFrameSource(settings.device_num, settings.width, settings.height)
+    planner = StoragePlanner(settings.byte_budget, len(settings.file_list), settings.file_length_max)
+
+    # サムネイルは書き込みスレッドから送るため、送信はロックしてから行う
+    send_lock = Lock()
+
+    def on_frame_written(frame_num: int, image: cv2.Mat) -> None:
+        if frame_num % settings.thumbnail_interval == 0:
+            thumbnail = make_thumbnail(image, settings.thumbnail_width)
+            with send_lock:
+                status_conn.send(("thumbnail", frame_num, thumbnail))
+
+    is_preview = True
+    stats_time = perf_counter()
+
+    def is_running() -> bool:
+        nonlocal is_preview, stats_time
+        while command_conn.poll():
+            command = command_conn.recv()
+            if command[0] == "stop":
+                return False
+            elif command[0] == "preview":
+                is_preview = command[1]
+        if perf_counter() - stats_time > STATS_INTERVAL:
+            stats_time = perf_counter()
+            retainable_length = planner.get_retainable_length() if settings.mmap_path is None else None
+            with send_lock:
+                status_conn.send(("stats", writer.get_dropped_frame_num(), retainable_length))
+        return True
+
+    def on_recorded_frame(pooled_frame: PooledFrame) -> None:
+        # UI側が前のフレームを読み終わっている場合だけ共有メモリにコピーする
+        if is_preview and header[0] == header[1]:
+            frame = pooled_frame.image
+            if frame.shape != preview.shape:
+                frame = cv2.resize(frame, (settings.width, settings.height))
+            np.copyto(preview, frame)
+            header[0] += 1
+
+    writer = create_writer(settings, planner, on_frame_written)
+    try:
+        if source.is_opened():
+            run_recording(source, writer, FramePool(settings.buffer_size_max + 8), is_running, on_recorded_frame)
+        else:
+            # 入力デバイスを開けなかった場合はstopが来るまで待つ
+            while command_conn.recv()[0] != "stop":
+                pass
+    finally:
+        result = writer.release()
+        file_list = result if isinstance(result, list) else settings.file_list
+        next_frame_num = writer.get_next_frame_num() if isinstance(writer, RingVideoWriter) else settings.frame_offset
+        with send_lock:
+            status_conn.send(("stopped", file_list, writer.get_dropped_frame_num(), next_frame_num))
+        source.release()
+        del header, preview
+        shm.close()
+
+
+class RecordingProcess(object):
+    """
+    入力デバイスの読み込みと書き込みを子プロセスで行う。
+    プレビュー用のフレームは共有メモリで受け取り、コマンドと統計、サムネイルはパイプでやり取りする。
+    JpegFrameRingはプロセス間で共有できないため、ファイル(RingVideoWriter)かMmapFrameRingのみ対応する。
+    """
+
+    def __init__(
+        self,
+        settings: RecordingProcessSettings,
+        frame_callback: Callable[[cv2.Mat], None],
+        frame_source_factory: Optional[Callable[[], FrameSource]] = None,
+        thumbnail_callback: Optional[Callable[[int, cv2.Mat], None]] = None,
+    ):
+        header_size = PREVIEW_HEADER_DTYPE.itemsize * PREVIEW_HEADER_NUM
+        self._shm = shared_memory.SharedMemory(create=True, size=header_size + settings.width * settings.height * 3)
+        self._header = np.ndarray((PREVIEW_HEADER_NUM,), dtype=PREVIEW_HEADER_DTYPE, buffer=self._shm.buf)
+        self._header[:] = 0
+        self._preview = np.ndarray(
+            (settings.height, settings.width, 3), dtype=np.uint8, buffer=self._shm.buf, offset=header_size
+        )
+        self._frame_callback = frame_callback
+        self._thumbnail_callback = thumbnail_callback
+
+        command_receiver, self._command_conn = Pipe(duplex=False)
+        self._status_conn, status_sender = Pipe(duplex=False)
+        self._process = Process(
+            target=_recording_process_main,
+            args=(command_receiver, status_sender, settings, self._shm.name, frame_source_factory),
+            daemon=True,
+        )
+        self._process.start()
+
+        self.file_list = settings.file_list
+        self.dropped_frame_num = 0
+        self.next_frame_num = settings.frame_offset  # 終了後に、次に書き込むフレームの通し番号が入る
+        self.retainable_length: Optional[float] = None  # 容量の制限で保持できるリプレイの長さ[s]
+        self._stopped = Event()
+        self._receive_thread = Thread(target=self._receive_task)
+        self._receive_thread.start()
+
+    def set_preview(self, is_preview: bool) -> None:
+        self._command_conn.send(("preview", is_preview))
+
+    def stop(self) -> List[str]:
+        # 書き込みを終了し、古い順に並べたファイルのリストを返す
+        if self._process.is_alive():
+            self._command_conn.send(("stop",))
+            self._process.join()
+        self._stopped.set()
+        self._receive_thread.join()
+        del self._header, self._preview
+        self._shm.close()
+        self._shm.unlink()
+        return self.file_list
+
+    def _receive_task(self) -> None:
+        while True:
+            if self._status_conn.poll(0.005):
+                try:
+                    message = self._status_conn.recv()
+                except EOFError:
+                    break
+                if message[0] == "stats":
+                    self.dropped_frame_num = message[1]
+                    self.retainable_length = message[2]
+                elif message[0] == "thumbnail":
+                    if self._thumbnail_callback is not None:
+                        self._thumbnail_callback(message[1], message[2])
+                elif message[0] == "stopped":
+                    self.file_list = message[1]
+                    self.dropped_frame_num = message[2]
+                    self.next_frame_num = message[3]
+                    break
+            elif self._stopped.is_set():
+                break
+
+            if self._header[0] != self._header[1]:
+                frame = self._preview.copy()
+                self._header[1] = self._header[0]
+                self._frame_callback(frame)
@@ -2,12 +2,69 @@
 # This software is released under the MIT License
 # https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
 
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from enum import Enum, auto
 import queue
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import cv2
-from threading import Thread
+import numpy as np
+from threading import Condition, Lock, Thread
+from time import monotonic, perf_counter
 import os
 
+from frame_pool import PooledFrame, as_image, release_frame, retain_frame
+from storage_planner import SegmentInfo
+
+# セグメントごとのフレームインデックス(動画ファイルと同じ場所に保存する)
+# frame: 録画をまたいで続けて振る通し番号, timestamp: 書き込み時刻(time.monotonic), keyframe: キーフレームかどうか
+INDEX_DTYPE = np.dtype([("frame", "<i8"), ("timestamp", "<f8"), ("keyframe", "?")])
+INDEX_EXTENSION = ".idx"
+
+# cv2.VideoWriter(FFMPEG)はmp4vのGOPを12フレームで出力する
+DEFAULT_KEYFRAME_INTERVAL = 12
+
+
+# シーク用の低解像度のプロキシ(フレーム内圧縮のみ)。マスターのセグメントと同じ場所に保存する
+PROXY_EXTENSION = ".proxy.avi"
+PROXY_FOURCC = cv2.VideoWriter_fourcc(*"MJPG")
+
+
+def get_index_path(file_path: str) -> str:
+    return file_path + INDEX_EXTENSION
+
+
+def save_index(file_path: str, index: np.ndarray) -> None:
+    with open(get_index_path(file_path), "wb") as f:
+        np.save(f, index)
+
+
+def load_index(file_path: str) -> Optional[np.ndarray]:
+    try:
+        with open(get_index_path(file_path), "rb") as f:
+            return np.load(f)
+    except (OSError, ValueError):
+        # インデックスが無い、または壊れている場合
+        return None
+
+
+def remove_index(file_path: str) -> None:
+    try:
+        os.remove(get_index_path(file_path))
+    except FileNotFoundError:
+        pass
+
+
+def get_proxy_path(file_path: str) -> str:
+    return file_path + PROXY_EXTENSION
+
+
+def get_proxy_size(frame_size: Tuple[int, int], proxy_width: int) -> Tuple[int, int]:
+    # 縦横比を保ったまま幅をproxy_widthまで縮小する。高さは偶数にそろえる
+    width, height = frame_size
+    proxy_width = min(proxy_width, width)
+    return proxy_width, max(2, round(height * proxy_width / width / 2) * 2)
+
 
 class RingCounter(object):
     def __init__(self, max: int, min: int = 0):
@@ -25,10 +82,193 @@ class RingCounter(object):
         return (index + self._counter) % (self._counter_max - self._counter_min) + self._counter_min
 
 
-class RingVideoWriter(object):
-    class BufferOverflowException(Exception):
-        pass
+class FrameCache(object):
+    """
+    再生位置周辺のデコード済みフレームを保持する。
+    容量(バイト数)を超えた場合は再生位置から遠いフレームから破棄する。
+    """
+
+    def __init__(self, byte_max: int):
+        self._frames: Dict[int, cv2.Mat] = {}
+        self._byte_max = byte_max
+        self._byte_num = 0
+
+    def get(self, frame_num: int) -> Optional[cv2.Mat]:
+        return self._frames.get(frame_num)
+
+    def get_nearest(self, frame_num: int, distance_max: int) -> Optional[Tuple[int, cv2.Mat]]:
+        # distance_max以内で最も近いフレームを(フレーム番号, フレーム)で返す
+        if len(self._frames) == 0:
+            return None
+        nearest = min(self._frames, key=lambda key: abs(key - frame_num))
+        if abs(nearest - frame_num) > distance_max:
+            return None
+        return nearest, self._frames[nearest]
+
+    def put(self, frame_num: int, frame: cv2.Mat, center: int) -> None:
+        if frame.nbytes > self._byte_max or frame_num in self._frames:
+            return
+        self._frames[frame_num] = frame
+        self._byte_num += frame.nbytes
+        while self._byte_num > self._byte_max:
+            farthest = max(self._frames, key=lambda key: abs(key - center))
+            self._byte_num -= self._frames.pop(farthest).nbytes
+
+    def clear(self) -> None:
+        self._frames.clear()
+        self._byte_num = 0
+
+
+class OverflowPolicy(Enum):
+    BLOCK = auto()  # 空きができるまで待つ
+    DROP_NEWEST = auto()  # 書き込もうとしたフレームを捨てる
+    DROP_OLDEST = auto()  # バッファ内の一番古いフレームを捨てる
+    ADAPTIVE = auto()  # バッファが半分以上埋まっている間は1フレームおきに間引く
+
+
+@dataclass
+class WriterStats(object):
+    dropped_frame_num: int  # 書き込みが間に合わずに捨てたフレーム数
+    high_water_num: int  # バッファに溜まったフレーム数の最大値
+    rotation_times: List[float] = field(default_factory=list)  # セグメントの切り替えにかかった時間[s]
+
+
+class WriterBuffer(object):
+    """
+    書き込み待ちのフレームを溜めておくバッファ。
+    満杯のときの動作をOverflowPolicyで選択でき、捨てたフレーム数を数えておく。
+    PooledFrameはバッファに入っている間retainしておき、取り出した側が書き込み後にreleaseする。
+    """
+
+    def __init__(self, max_buffer_num: int, policy: OverflowPolicy = OverflowPolicy.ADAPTIVE):
+        self._buffer = queue.Queue(maxsize=max_buffer_num)
+        self._policy = policy
+        self._is_skip = False
+        self.dropped_frame_num = 0
+        self.high_water_num = 0
+
+    def put(self, item: Tuple[Union[cv2.Mat, PooledFrame], float]) -> None:
+        retain_frame(item[0])
+        if self._policy == OverflowPolicy.BLOCK:
+            self._buffer.put(item)
+            self.high_water_num = max(self.high_water_num, self._buffer.qsize())
+            return
+
+        if self._policy == OverflowPolicy.ADAPTIVE:
+            if self._buffer.qsize() * 2 >= self._buffer.maxsize:
+                self._is_skip = not self._is_skip
+                if self._is_skip:
+                    self.dropped_frame_num += 1
+                    release_frame(item[0])
+                    return
+            else:
+                self._is_skip = False
+
+        while True:
+            try:
+                self._buffer.put_nowait(item)
+                self.high_water_num = max(self.high_water_num, self._buffer.qsize())
+                return
+            except queue.Full:
+                if self._policy != OverflowPolicy.DROP_OLDEST:
+                    self.dropped_frame_num += 1
+                    release_frame(item[0])
+                    return
+            try:
+                release_frame(self._buffer.get_nowait()[0])
+                self.dropped_frame_num += 1
+            except queue.Empty:
+                pass
+
+    def get(self, timeout: float) -> Tuple[Union[cv2.Mat, PooledFrame], float]:
+        # 空の場合はqueue.Emptyが発生する
+        return self._buffer.get(timeout=timeout)
+
+
+class ProxyWriter(object):
+    """
+    RingVideoWriterのセグメントごとに、シーク用の低解像度のプロキシを別スレッドで書き込む。
+    フレーム内圧縮のみ(MJPG)のため、どのフレームもキーフレームから読み進めずに読み込める。
+    フレーム番号をマスターと揃えるため、書き込みが間に合わない場合はフレームを捨てずに直前のフレームを繰り返す。
+    """
+
+    def __init__(
+        self,
+        frame_rate: float,
+        frame_size: Tuple[int, int],
+        max_buffer_num: int = 60,
+        segment_callback: Optional[Callable[[SegmentInfo], None]] = None,
+    ):
+        self._frame_rate = frame_rate
+        self._frame_size = frame_size
+        self._max_buffer_num = max_buffer_num
+        self._segment_callback = segment_callback
+        # (フレーム, フレーム番号, タイムスタンプ, マスターのセグメント)。フレームがNoneの場合は直前のフレームを繰り返す
+        self._items: List[Tuple[Optional[Union[cv2.Mat, PooledFrame]], int, float, str]] = []
+        self._condition = Condition()
+        self._is_run = True
+        self.repeated_frame_num = 0
+        self._writer_thread = Thread(target=self._writer_task)
+        self._writer_thread.start()
+
+    def write(self, frame: Union[cv2.Mat, PooledFrame], frame_num: int, timestamp: float, file_path: str) -> None:
+        retain_frame(frame)
+        with self._condition:
+            if len(self._items) >= self._max_buffer_num:
+                release_frame(frame)
+                frame = None
+            self._items.append((frame, frame_num, timestamp, file_path))
+            self._condition.notify_all()
+
+    def release(self) -> None:
+        # 溜まっているフレームを書き終えてから閉じる
+        with self._condition:
+            self._is_run = False
+            self._condition.notify_all()
+        self._writer_thread.join()
+
+    def _finalize_segment(self, writer: cv2.VideoWriter, file_path: str, index: List[Tuple[int, float, bool]]) -> None:
+        writer.release()
+        save_index(file_path, np.array(index, dtype=INDEX_DTYPE))
+        if self._segment_callback is not None and os.path.exists(file_path):
+            # 長さはマスターのセグメントで数えるため、サイズだけを通知する
+            self._segment_callback(SegmentInfo(file_path, os.path.getsize(file_path), 0.0))
+
+    def _writer_task(self) -> None:
+        writer: Optional[cv2.VideoWriter] = None
+        file_path = ""
+        index: List[Tuple[int, float, bool]] = []
+        image = np.zeros((self._frame_size[1], self._frame_size[0], 3), dtype=np.uint8)
+        while True:
+            with self._condition:
+                while len(self._items) == 0 and self._is_run:
+                    self._condition.wait()
+                if len(self._items) == 0:
+                    break
+                frame, frame_num, timestamp, master_path = self._items.pop(0)
 
+            if writer is None or get_proxy_path(master_path) != file_path:
+                # マスターのセグメントが切り替わった
+                if writer is not None:
+                    self._finalize_segment(writer, file_path, index)
+                file_path = get_proxy_path(master_path)
+                index = []
+                remove_index(file_path)
+                writer = cv2.VideoWriter(file_path, PROXY_FOURCC, self._frame_rate, self._frame_size)
+
+            if frame is not None:
+                image = cv2.resize(as_image(frame), self._frame_size, interpolation=cv2.INTER_AREA)
+                release_frame(frame)
+            else:
+                self.repeated_frame_num += 1
+            writer.write(image)
+            index.append((frame_num, timestamp, True))
+
+        if writer is not None:
+            self._finalize_segment(writer, file_path, index)
+
+
+class RingVideoWriter(object):
     class Param(object):
         def __init__(self, fmt: cv2.VideoWriter_fourcc, frame_rate: float, frame_size: Tuple[int, int]):
             self.fmt = fmt
@@ -43,130 +283,422 @@ class RingVideoWriter(object):
         frame_size: Tuple[int, int],
         file_length_max: int = 10,
         max_buffer_num: int = 60,
+        keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL,
+        preopen_length: float = 1.0,
+        overflow_policy: OverflowPolicy = OverflowPolicy.ADAPTIVE,
+        segment_callback: Optional[Callable[[SegmentInfo], None]] = None,
+        proxy_width: Optional[int] = None,
+        thumbnail_callback: Optional[Callable[[int, cv2.Mat], None]] = None,
+        frame_offset: int = 0,
     ):
-        self._buffer = queue.Queue(maxsize=max_buffer_num)
+        self._buffer = WriterBuffer(max_buffer_num, overflow_policy)
         self._file_frame_max = int(frame_rate * file_length_max)
         self._file_list = file_list
-        self._writer = cv2.VideoWriter(file_list[0], fmt, frame_rate, frame_size)
+        self._keyframe_interval = keyframe_interval
+        self._index: List[Tuple[int, float, bool]] = []
+        # フレームの通し番号。録画をまたいで番号が重ならないように、前の録画の続きから始められる
+        self._frame_count = frame_offset
         self._param = RingVideoWriter.Param(fmt, frame_rate, frame_size)
+        self._writer = self._open_writer(file_list[0])
+
+        # セグメントの切り替えで書き込みが止まらないように、
+        # 次のファイルは切り替えのpreopen_length秒前に別スレッドで開いておき、書き終わったファイルも別スレッドで閉じる。
+        # ファイルが1つしかない場合は書き込み中のファイルを開き直すことになるため切り替え時に開く。
+        self._preopen_frame_num = min(int(frame_rate * preopen_length), self._file_frame_max // 2)
+        self._next_writer: Optional[cv2.VideoWriter] = None
+        self._preopen_thread: Optional[Thread] = None
+        self._finalize_threads: List[Thread] = []
+        self._rotation_times: List[float] = []
+
+        # 書き終わったセグメントのサイズを通知する。容量に合わせて使うファイル数を減らせる(set_active_file_num)
+        self._segment_callback = segment_callback
+        self._active_file_num = len(file_list)
+
+        # proxy_widthを指定した場合は、シーク用の低解像度のプロキシも書き込む(get_proxy_path)
+        self._proxy: Optional[ProxyWriter] = None
+        if proxy_width is not None:
+            self._proxy = ProxyWriter(
+                frame_rate, get_proxy_size(frame_size, proxy_width), max_buffer_num, segment_callback
+            )
+
+        # 書き込んだフレームをフレームの通し番号と一緒に渡す(サムネイルの作成用)
+        self._thumbnail_callback = thumbnail_callback
+
         self._writer_thread = Thread(target=self._writer_task)
         self._counter = RingCounter(len(file_list))
         self._is_run = True
         self._writer_thread.start()
 
-    def write(self, frame: cv2.Mat) -> None:
-        try:
-            self._buffer.put_nowait(frame)
-        except queue.Full:
-            raise RingVideoWriter.BufferOverflowException(f"overflow -> buffer max : {self._buffer.maxsize}")
+    def write(self, frame: Union[cv2.Mat, PooledFrame], timestamp: Optional[float] = None) -> None:
+        if timestamp is None:
+            timestamp = monotonic()
+        self._buffer.put((frame, timestamp))
+
+    def get_dropped_frame_num(self) -> int:
+        return self._buffer.dropped_frame_num
+
+    def get_next_frame_num(self) -> int:
+        # 次に書き込むフレームの通し番号。release後に呼ぶと次の録画のframe_offsetに使える
+        return self._frame_count
+
+    def get_stats(self) -> WriterStats:
+        return WriterStats(self._buffer.dropped_frame_num, self._buffer.high_water_num, list(self._rotation_times))
+
+    def set_active_file_num(self, file_num: int) -> None:
+        # 新しい方からfile_num個(書き込み中のファイルを含む)だけを残し、古いファイルは次の切り替え時に消す
+        self._active_file_num = min(max(2, file_num), len(self._file_list))
 
     def release(self) -> List[str]:
         if self._is_run:
             self._is_run = False
             self._writer_thread.join()
-            self._writer.release()
+            self._finalize_segment(self._writer, self._file_list[self._counter[0]], self._index)
+            if self._preopen_thread is not None:
+                # 開いておいた次のファイルは使われなかったので閉じる(フレーム数0のファイルになる)
+                self._preopen_thread.join()
+                self._next_writer.release()
+            for thread in self._finalize_threads:
+                thread.join()
+            if self._proxy is not None:
+                self._proxy.release()
         return [self._file_list[self._counter[i + 1]] for i in range(len(self._file_list))]
 
+    def _open_writer(self, file_path: str) -> cv2.VideoWriter:
+        remove_index(file_path)
+        return cv2.VideoWriter(file_path, self._param.fmt, self._param.frame_rate, self._param.frame_size)
+
+    def _preopen_task(self, file_path: str) -> None:
+        self._next_writer = self._open_writer(file_path)
+
+    def _finalize_segment(self, writer: cv2.VideoWriter, file_path: str, index: List[Tuple[int, float, bool]]) -> None:
+        writer.release()
+        save_index(file_path, np.array(index, dtype=INDEX_DTYPE))
+        if self._segment_callback is not None and len(index) > 0 and os.path.exists(file_path):
+            # 最後のフレームの表示時間の分として1フレーム分を足す
+            length = index[-1][1] - index[0][1] + 1 / self._param.frame_rate
+            self._segment_callback(SegmentInfo(file_path, os.path.getsize(file_path), length))
+
+    def _remove_inactive_segments(self) -> None:
+        # 使うファイル数を超えた古いファイルを消す。counter[1]は次に書き込むファイル
+        for i in range(1, len(self._file_list) - self._active_file_num + 1):
+            file_path = self._file_list[self._counter[i]]
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            remove_index(file_path)
+            if self._proxy is not None:
+                try:
+                    os.remove(get_proxy_path(file_path))
+                except FileNotFoundError:
+                    pass
+                remove_index(get_proxy_path(file_path))
+
+    def _rotate(self) -> None:
+        # 書き終わったファイルを閉じて次のファイルに切り替える
+        writer, file_path, index = self._writer, self._file_list[self._counter[0]], self._index
+        self._index = []
+        self._counter.increment()
+        if self._preopen_thread is None:
+            self._finalize_segment(writer, file_path, index)
+            self._writer = self._open_writer(self._file_list[self._counter[0]])
+            return
+
+        finalize_thread = Thread(target=self._finalize_segment, args=(writer, file_path, index))
+        finalize_thread.start()
+        self._finalize_threads = [thread for thread in self._finalize_threads if thread.is_alive()]
+        self._finalize_threads.append(finalize_thread)
+
+        self._preopen_thread.join()
+        self._preopen_thread = None
+        self._writer = self._next_writer
+        self._next_writer = None
+
     def _writer_task(self) -> None:
         counter = 0
         while True:
             try:
-                frame = self._buffer.get(timeout=0.5)
-                self._writer.write(frame)
+                frame, timestamp = self._buffer.get(timeout=0.5)
+                self._writer.write(as_image(frame))
+                if self._proxy is not None:
+                    self._proxy.write(frame, self._frame_count, timestamp, self._file_list[self._counter[0]])
+                if self._thumbnail_callback is not None:
+                    self._thumbnail_callback(self._frame_count, as_image(frame))
+                release_frame(frame)
+                self._index.append((self._frame_count, timestamp, counter % self._keyframe_interval == 0))
+                self._frame_count += 1
                 counter += 1
+                if (
+                    counter >= self._file_frame_max - self._preopen_frame_num
+                    and self._preopen_thread is None
+                    and len(self._file_list) > 1
+                ):
+                    self._preopen_thread = Thread(target=self._preopen_task, args=(self._file_list[self._counter[1]],))
+                    self._preopen_thread.start()
                 if counter >= self._file_frame_max:
                     counter = 0
-                    self._counter.increment()
-                    self._writer = cv2.VideoWriter(
-                        self._file_list[self._counter[0]],
-                        self._param.fmt,
-                        self._param.frame_rate,
-                        self._param.frame_size,
-                    )
+                    rotation_start = perf_counter()
+                    self._rotate()
+                    self._rotation_times.append(perf_counter() - rotation_start)
+                    self._remove_inactive_segments()
             except queue.Empty:
                 if self._is_run is False:
                     break
 
 
 class RingVideoCapture(object):
+    """
+    RingVideoWriterで書き込んだセグメントを1本の動画として読み込む。
+    retention_lengthを指定した場合は、最後のフレームからretention_length秒前までのフレームだけを対象にする。
+    セグメントは読み込むときに開き、開いたままにしておくのは最近使ったOPEN_SEGMENT_MAX個までにする。
+    use_proxy=Trueで全セグメントのプロキシがそろっている場合は、read_approximateでプロキシのフレームを返す。
+    """
+
+    OPEN_SEGMENT_MAX = 4
+
     class _Capture:
-        def __init__(self, file_path: str):
-            self.capture = cv2.VideoCapture(file_path)
-            self.frame_num = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        def __init__(self, file_path: str, offset: int, decoded_callback: Callable[[int, cv2.Mat, int], None]):
+            self.file_path = file_path
+            self.capture: Optional[cv2.VideoCapture] = None
+            self.offset = offset  # 先頭からの通しのフレーム番号
+            self.decoded_callback = decoded_callback
+            self.index = load_index(file_path)
+            if self.index is not None:
+                self.frame_num = len(self.index)
+                self.keyframes = np.flatnonzero(self.index["keyframe"])
+            else:
+                # インデックスが無い場合はコンテナの情報を使う
+                self.open()
+                self.frame_num = max(0, int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT)))
+                self.keyframes = None
+            self.position = 0  # 次にデコードされるフレーム
+            self.target = 0  # 次に読み込みたいフレーム
 
-    def __init__(self, file_list: List[str]):
-        self._caps = [RingVideoCapture._Capture(file) for file in file_list if os.path.exists(file)]
-        self._cap_cursor = 0
-        self._frame_cursor = 0
-        self._frame_num = sum([cap.frame_num for cap in self._caps])
+        def is_opened(self) -> bool:
+            return self.capture is not None
+
+        def open(self) -> None:
+            if self.capture is None:
+                self.capture = cv2.VideoCapture(self.file_path)
+                self.position = 0
+
+        def close(self) -> None:
+            if self.capture is not None:
+                self.capture.release()
+                self.capture = None
+
+        def get_keyframe(self, frame_num: int) -> int:
+            # frame_num以前で最も近いキーフレーム。インデックスが無い場合はframe_numをそのまま返す
+            if self.keyframes is None:
+                return frame_num
+            i = int(np.searchsorted(self.keyframes, frame_num, side="right")) - 1
+            return int(self.keyframes[i]) if i >= 0 else 0
+
+        def seek(self, frame_num: int) -> None:
+            # 実際の移動は次のreadまで遅延させる
+            self.target = frame_num
+
+        def read(self) -> cv2.Mat:
+            if self.position != self.target:
+                self._decode_to(self.target)
+            ret, frame = self.capture.read()
+            if ret:
+                self.position += 1
+                self.target = self.position
+            return frame
+
+        def _decode_to(self, frame_num: int) -> None:
+            if self.keyframes is None:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+                self.position = frame_num
+                return
+
+            # 直前のキーフレームに移動してから目的のフレームまで読み進める。
+            # 現在位置から読み進めた方が近い場合はシークしない。
+            keyframe = self.get_keyframe(frame_num)
+            is_backward = frame_num < self.position
+            if not (keyframe <= self.position <= frame_num):
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+                self.position = keyframe
+            while self.position < frame_num:
+                if is_backward:
+                    # コマ戻しが続く場合に備え、途中のフレームもデコードしてキャッシュしておく
+                    ret, frame = self.capture.read()
+                    if ret:
+                        self.decoded_callback(self.offset + self.position, frame, self.offset + frame_num)
+                else:
+                    ret = self.capture.grab()
+                if not ret:
+                    break
+                self.position += 1
+
+    def __init__(
+        self,
+        file_list: List[str],
+        cache_byte_max: int = 0,
+        retention_length: Optional[float] = None,
+        use_proxy: bool = False,
+    ):
+        self._cache = FrameCache(cache_byte_max)
+        self._caps: List[RingVideoCapture._Capture] = []
+        self._opened_caps: List[RingVideoCapture._Capture] = []  # 開いているセグメント。最後が最近使ったもの
+        for file in file_list:
+            if os.path.exists(file):
+                cap = RingVideoCapture._Capture(file, 0, self._cache.put)
+                if cap.frame_num == 0:
+                    cap.close()
+                    continue
+                self._caps.append(cap)
+        self._trim_frame_num = 0  # 先頭のセグメントから除いたフレーム数
+        if retention_length is not None:
+            self._trim(retention_length)
+
+        # 各セグメントの先頭フレームの通し番号(累積和)。
+        # 先頭のセグメントは保持する長さより古い部分を除くため、オフセットが負になることがある。
+        self._offsets: List[int] = []
+        offset = -self._trim_frame_num
+        for cap in self._caps:
+            cap.offset = offset
+            self._offsets.append(offset)
+            offset += cap.frame_num
+        self._frame_num = max(0, offset)
+        self._cursor = 0  # 次に読み込むフレームの通し番号
+        for cap in self._caps:
+            cap.close()
+
+        self._proxy: Optional[RingVideoCapture] = None
+        self._frame_size: Optional[Tuple[int, int]] = None  # プロキシのフレームを拡大する大きさ
+        if use_proxy:
+            self._open_proxy(retention_length)
+
+    def _open_proxy(self, retention_length: Optional[float]) -> None:
+        # セグメントとフレーム数が一致する場合だけプロキシを使う
+        proxy_list = [get_proxy_path(cap.file_path) for cap in self._caps]
+        if len(proxy_list) == 0 or not all(os.path.exists(file) for file in proxy_list):
+            return
+        proxy = RingVideoCapture(proxy_list, 0, retention_length)
+        if proxy._offsets == self._offsets and proxy._frame_num == self._frame_num:
+            self._proxy = proxy
+        else:
+            proxy.release()
+
+    def _trim(self, retention_length: float) -> None:
+        # 最後のフレームからretention_length秒より前のフレームを除く。タイムスタンプが無い場合は何もしない
+        if len(self._caps) == 0 or any(cap.index is None for cap in self._caps):
+            return
+        start_time = float(self._caps[-1].index["timestamp"][-1]) - retention_length
+        while len(self._caps) > 1 and float(self._caps[0].index["timestamp"][-1]) < start_time:
+            self._caps.pop(0).close()
+        self._trim_frame_num = int(np.searchsorted(self._caps[0].index["timestamp"], start_time, side="left"))
+
+    def _use(self, cap: "RingVideoCapture._Capture") -> None:
+        # セグメントを開き、開いているセグメントが多すぎる場合は最も使っていないものを閉じる
+        if cap in self._opened_caps:
+            self._opened_caps.remove(cap)
+        else:
+            cap.open()
+        self._opened_caps.append(cap)
+        if len(self._opened_caps) > RingVideoCapture.OPEN_SEGMENT_MAX:
+            self._opened_caps.pop(0).close()
 
     def release(self) -> None:
         for cap in self._caps:
-            cap.capture.release()
+            cap.close()
+        self._opened_caps.clear()
+        self._cache.clear()
+        if self._proxy is not None:
+            self._proxy.release()
+
+    def has_proxy(self) -> bool:
+        return self._proxy is not None
+
+    def _locate(self, frame_num: int) -> Tuple["RingVideoCapture._Capture", int]:
+        # 通しのフレーム番号から(セグメント, セグメント内のフレーム番号)を求める
+        cap = self._caps[bisect_right(self._offsets, frame_num) - 1]
+        return cap, frame_num - cap.offset
 
     def read(self) -> cv2.Mat:
-        tmp_cap = self._caps[self._cap_cursor]
-        _, frame = tmp_cap.capture.read()
-        if self._frame_cursor < tmp_cap.frame_num:
-            self._frame_cursor += 1
-        if self._frame_cursor >= tmp_cap.frame_num:
-            if self._cap_cursor != len(self._caps) - 1 and self._caps[self._cap_cursor + 1].frame_num != 0:
-                self._cap_cursor += 1
-                self._frame_cursor = 0
+        if self._cursor >= self._frame_num:
+            return None
+        frame = self._cache.get(self._cursor)
+        if frame is None:
+            cap, local_frame = self._locate(self._cursor)
+            self._use(cap)
+            cap.seek(local_frame)
+            frame = cap.read()
+            if frame is None:
+                return None
+            self._cache.put(self._cursor, frame, self._cursor)
+        self._cursor += 1
+        return frame
+
+    def read_approximate(self, frame_num: int, distance_max: int = DEFAULT_KEYFRAME_INTERVAL) -> Optional[cv2.Mat]:
+        """
+        シーク中に先に表示するための、frame_numに近いフレームを返す。カーソルは移動しない。
+        distance_max以内にキャッシュ済みのフレームがあればそれを、無ければ直前のキーフレームだけをデコードして返す。
+        キーフレームからframe_numまでは続けてreadしたときに読み進めるため、デコードが無駄にはならない。
+        プロキシがある場合は、キャッシュに無ければframe_numのプロキシのフレームを元の大きさに拡大して返す。
+        """
+        if self._frame_num == 0:
+            return None
+        frame_num = min(max(0, frame_num), self._frame_num - 1)
+        if self._proxy is not None:
+            frame = self._cache.get(frame_num)
+            if frame is None:
+                frame = self._read_proxy(frame_num)
+            return frame
+        nearest = self._cache.get_nearest(frame_num, distance_max)
+        if nearest is not None:
+            return nearest[1]
+        cap, local_frame = self._locate(frame_num)
+        keyframe = cap.get_keyframe(local_frame)
+        self._use(cap)
+        cap.seek(keyframe)
+        frame = cap.read()
+        if frame is not None:
+            self._cache.put(cap.offset + keyframe, frame, frame_num)
+        return frame
+
+    def _read_proxy(self, frame_num: int) -> Optional[cv2.Mat]:
+        self._proxy.move_frame(frame_num)
+        frame = self._proxy.read()
+        if frame is None:
+            return None
+        if self._frame_size is None:
+            # マスターの大きさはコンテナの情報から求める(デコードはしない)
+            cap, _ = self._locate(frame_num)
+            self._use(cap)
+            self._frame_size = (
+                int(cap.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(cap.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            )
+        if self._frame_size[0] > 0 and (frame.shape[1], frame.shape[0]) != self._frame_size:
+            frame = cv2.resize(frame, self._frame_size, interpolation=cv2.INTER_LINEAR)
         return frame
 
     def move_first(self) -> None:
         # 0フレーム目に移動
-        self._cap_cursor = 0
-        self._frame_cursor = 0
-        self._caps[0].capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self._cursor = 0
 
     def move_last(self) -> None:
         # 最終フレームへ移動
-        for i, cap in enumerate(self._caps[-1::-1]):
-            if cap.frame_num != 0:
-                self._cap_cursor = len(self._caps) - 1 - i
-                break
-        self._frame_cursor = self._caps[self._cap_cursor].frame_num - 1
-        self._caps[self._cap_cursor].capture.set(cv2.CAP_PROP_POS_FRAMES, self._frame_cursor)
+        self._cursor = max(0, self._frame_num - 1)
 
     def move_diff(self, diff: int) -> None:
-        self._frame_cursor += diff
-        if diff < 0:
-            if self._cap_cursor != 0:
-                for i, cap in enumerate(self._caps[self._cap_cursor - 1 :: -1]):
-                    if self._frame_cursor >= 0:
-                        self._cap_cursor -= i
-                        self._caps[self._cap_cursor].capture.set(cv2.CAP_PROP_POS_FRAMES, self._frame_cursor)
-                        return
-                    else:
-                        self._frame_cursor += cap.frame_num
-
-            # self._cap_cursor == 0になったときの処理
-            if self._frame_cursor < 0:
-                self.move_first()
-                return
-            else:
-                self._cap_cursor = 0  # self._cap_cursor = 0と実質同じ
-                self._caps[self._cap_cursor].capture.set(cv2.CAP_PROP_POS_FRAMES, self._frame_cursor)
-                return
-
-        elif diff > 0:
-            for i, cap in enumerate(self._caps[self._cap_cursor : :]):
-                if self._frame_cursor < cap.frame_num:
-                    self._cap_cursor += i
-                    self._caps[self._cap_cursor].capture.set(cv2.CAP_PROP_POS_FRAMES, self._frame_cursor)
-                    return
-                else:
-                    self._frame_cursor -= cap.frame_num
-            else:
-                self.move_last()
+        # 範囲オーバーの場合もエラーにならず端で止まる
+        if diff != 0:
+            self._cursor = min(max(0, self._cursor + diff), max(0, self._frame_num - 1))
 
     def move_frame(self, frame_num: int) -> None:
         # 指定のフレームに移動する。
         # 範囲オーバーの場合もエラーにならず端で止まる
-        self.move_first()
-        self.move_diff(frame_num)
+        self._cursor = min(max(0, frame_num), max(0, self._frame_num - 1))
+
+    def is_live(self) -> bool:
+        return False
+
+    def get_first_frame(self) -> int:
+        return 0
 
     def get_frame_num(self) -> int:
         return self._frame_num
@@ -174,10 +706,585 @@ class RingVideoCapture(object):
     def get_now_frame(self) -> int:
         # cv2.VideoCaptureは読み込んだフレームの次のフレームにカーソルがあった状態になるため内部的には1ずらした状態になるが、
         # 使用する際には直前に読み込んだフレームの数字が表示された方が便利なので1マイナスしている。
-        frame_cursor = 0
-        if self._cap_cursor > 0:
-            for cap in self._caps[: self._cap_cursor :]:
-                frame_cursor += cap.frame_num
+        return self._cursor - 1
+
+    def get_timestamp(self, frame_num: int) -> Optional[float]:
+        # 録画時のタイムスタンプ(time.monotonic)。インデックスが無いセグメントの場合はNone
+        if frame_num < 0 or self._frame_num <= frame_num:
+            return None
+        cap, local_frame = self._locate(frame_num)
+        if cap.index is None:
+            return None
+        return float(cap.index["timestamp"][local_frame])
+
+    def get_global_frame(self, frame_num: int) -> Optional[int]:
+        # フレームの通し番号(INDEX_DTYPEのframe)。インデックスが無いセグメントの場合はNone
+        if frame_num < 0 or self._frame_num <= frame_num:
+            return None
+        cap, local_frame = self._locate(frame_num)
+        if cap.index is None:
+            return None
+        return int(cap.index["frame"][local_frame])
+
+
+class JpegFrameRing(object):
+    """
+    エンコード済み(JPEG)のフレームをメモリ上の固定長リングで保持する。
+    フレームには書き込み順の通し番号(seq)を振り、古いものから上書きされる。
+    """
+
+    def __init__(self, frame_num_max: int, quality: int = 90):
+        self._slots: List[Optional[np.ndarray]] = [None] * frame_num_max
+        self._timestamps = np.zeros(frame_num_max, dtype=np.float64)
+        self._frame_num_max = frame_num_max
+        self._quality = quality
+        self._write_count = 0
+        self._lock = Lock()
+
+    def put(self, frame: cv2.Mat, timestamp: float) -> int:
+        # 書き込んだフレームのseqを返す
+        _, data = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self._quality])
+        with self._lock:
+            seq = self._write_count
+            self._slots[seq % self._frame_num_max] = data
+            self._timestamps[seq % self._frame_num_max] = timestamp
+            self._write_count += 1
+        return seq
+
+    def get(self, seq: int) -> Optional[cv2.Mat]:
+        with self._lock:
+            first, end = self._get_range()
+            if seq < first or end <= seq:
+                return None
+            data = self._slots[seq % self._frame_num_max]
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    def get_timestamp(self, seq: int) -> Optional[float]:
+        with self._lock:
+            first, end = self._get_range()
+            if seq < first or end <= seq:
+                return None
+            return float(self._timestamps[seq % self._frame_num_max])
+
+    def get_range(self) -> Tuple[int, int]:
+        # 保持しているフレームのseqの範囲[first, end)
+        with self._lock:
+            return self._get_range()
+
+    def _get_range(self) -> Tuple[int, int]:
+        return max(0, self._write_count - self._frame_num_max), self._write_count
+
+
+class MmapFrameRing(object):
+    """
+    無圧縮のフレームを1つのファイルにメモリマップして固定長のリングで保持する。
+    ファイルはヘッダ(書き込み数、スロット数、高さ、幅)、各スロットのタイムスタンプのリング、
+    height*width*3バイトのスロットの順に並ぶ。
+    読み込みはコピーせずにスロットのビューを返すため、シークはスロットの位置の計算だけで済みデコードも不要になる。
+    書き込み中のリングから読み込む場合は、上書きで中身が変わらないようにget_copyを使う。
+    書き込み数はヘッダから読むため、attachで開いた別プロセスから書き込まれたフレームも読み込める。
+    """
+
+    HEADER_DTYPE = np.dtype("<i8")
+    HEADER_NUM = 4
+
+    def __init__(self, file_path: str, frame_num_max: int, frame_size: Tuple[int, int], is_create: bool = True):
+        width, height = frame_size
+        header_size = MmapFrameRing.HEADER_DTYPE.itemsize * MmapFrameRing.HEADER_NUM
+        timestamp_size = np.dtype("<f8").itemsize * frame_num_max
+        self._file_path = file_path
+        self._mmap = np.memmap(
+            file_path,
+            dtype=np.uint8,
+            mode="w+" if is_create else "r+",
+            shape=(MmapFrameRing.get_byte_num(frame_num_max, frame_size),),
+        )
+        self._header = self._mmap[:header_size].view(MmapFrameRing.HEADER_DTYPE)
+        self._timestamps = self._mmap[header_size : header_size + timestamp_size].view("<f8")
+        self._frames = self._mmap[header_size + timestamp_size :].reshape(frame_num_max, height, width, 3)
+        if is_create:
+            self._header[:] = (0, frame_num_max, height, width)
+        self._frame_num_max = frame_num_max
+        self._frame_size = frame_size
+        self._lock = Lock()
+
+    @classmethod
+    def attach(cls, file_path: str) -> "MmapFrameRing":
+        # 作成済みのリングを開く
+        header = np.memmap(file_path, dtype=cls.HEADER_DTYPE, mode="r", shape=(cls.HEADER_NUM,))
+        _, frame_num_max, height, width = [int(tmp) for tmp in header]
+        del header
+        return cls(file_path, frame_num_max, (width, height), is_create=False)
+
+    @staticmethod
+    def get_byte_num(frame_num_max: int, frame_size: Tuple[int, int]) -> int:
+        # リングのファイルのサイズ
+        width, height = frame_size
+        header_size = MmapFrameRing.HEADER_DTYPE.itemsize * MmapFrameRing.HEADER_NUM
+        return header_size + (np.dtype("<f8").itemsize + height * width * 3) * frame_num_max
+
+    def get_file_path(self) -> str:
+        return self._file_path
+
+    def put(self, frame: cv2.Mat, timestamp: float) -> int:
+        # 書き込んだフレームのseqを返す
+        if frame.shape != self._frames.shape[1:]:
+            frame = cv2.resize(frame, self._frame_size)
+        write_count = int(self._header[0])
+        slot = write_count % self._frame_num_max
+        np.copyto(self._frames[slot], frame)
+        self._timestamps[slot] = timestamp
+        with self._lock:
+            self._header[0] = write_count + 1
+        return write_count
+
+    def get(self, seq: int) -> Optional[cv2.Mat]:
+        with self._lock:
+            first, end = self._get_range()
+        if seq < first or end <= seq:
+            return None
+        return self._frames[seq % self._frame_num_max]
+
+    def get_copy(self, seq: int) -> Optional[cv2.Mat]:
+        # 書き込み中のリングから読み込む場合に使う。getのビューは上書きされると中身が変わるため、コピーを返す。
+        # コピーの途中で上書きが始まった場合はNone
+        if not self._is_safe(seq):
+            return None
+        frame = self._frames[seq % self._frame_num_max].copy()
+        if not self._is_safe(seq):
+            return None
+        return frame
+
+    def _is_safe(self, seq: int) -> bool:
+        # seqのスロットが上書きされておらず、書き込み中のフレームでも上書きされない。
+        # 書き込みはヘッダの書き込み数を増やす前にスロットを上書きするため、end-スロット数のseqは上書きの途中の可能性がある
+        with self._lock:
+            end = int(self._header[0])
+        return max(0, end - self._frame_num_max + 1) <= seq < end
+
+    def get_timestamp(self, seq: int) -> Optional[float]:
+        with self._lock:
+            first, end = self._get_range()
+        if seq < first or end <= seq:
+            return None
+        return float(self._timestamps[seq % self._frame_num_max])
+
+    def get_range(self) -> Tuple[int, int]:
+        # 保持しているフレームのseqの範囲[first, end)
+        with self._lock:
+            return self._get_range()
+
+    def _get_range(self) -> Tuple[int, int]:
+        write_count = int(self._header[0])
+        return max(0, write_count - self._frame_num_max), write_count
+
+
+class FrameRingWriter(object):
+    # RingVideoWriterと同じAPIでJpegFrameRing、MmapFrameRingに書き込む
+    def __init__(
+        self,
+        ring: Union[JpegFrameRing, MmapFrameRing],
+        max_buffer_num: int = 60,
+        overflow_policy: OverflowPolicy = OverflowPolicy.ADAPTIVE,
+        thumbnail_callback: Optional[Callable[[int, cv2.Mat], None]] = None,
+    ):
+        self._buffer = WriterBuffer(max_buffer_num, overflow_policy)
+        self._ring = ring
+        self._thumbnail_callback = thumbnail_callback  # (seq, フレーム)
+        self._writer_thread = Thread(target=self._writer_task)
+        self._is_run = True
+        self._writer_thread.start()
+
+    def write(self, frame: Union[cv2.Mat, PooledFrame], timestamp: Optional[float] = None) -> None:
+        if timestamp is None:
+            timestamp = monotonic()
+        self._buffer.put((frame, timestamp))
+
+    def get_dropped_frame_num(self) -> int:
+        return self._buffer.dropped_frame_num
+
+    def get_stats(self) -> WriterStats:
+        return WriterStats(self._buffer.dropped_frame_num, self._buffer.high_water_num)
+
+    def release(self) -> Union[JpegFrameRing, MmapFrameRing]:
+        if self._is_run:
+            self._is_run = False
+            self._writer_thread.join()
+        return self._ring
+
+    def _writer_task(self) -> None:
+        while True:
+            try:
+                frame, timestamp = self._buffer.get(timeout=0.5)
+                seq = self._ring.put(as_image(frame), timestamp)
+                if self._thumbnail_callback is not None:
+                    self._thumbnail_callback(seq, as_image(frame))
+                release_frame(frame)
+            except queue.Empty:
+                if self._is_run is False:
+                    break
+
+
+class FrameRingCapture(object):
+    """
+    RingVideoCaptureと同じAPIでJpegFrameRing、MmapFrameRingを読み込む。
+    通常は生成時点でリングに残っているフレームが対象になる。
+    is_live=Trueの場合は録画を続けているリングを読み込み、新しく書き込まれたフレームも対象になる(タイムシフト再生)。
+    フレーム番号は生成時点の先頭を0として固定し、古いフレームが上書きされると先頭のフレーム番号が大きくなっていく。
+    """
+
+    def __init__(self, ring: Union[JpegFrameRing, MmapFrameRing], is_live: bool = False):
+        self._ring = ring
+        self._is_live = is_live
+        self._first_seq, end_seq = ring.get_range()
+        self._frame_num = end_seq - self._first_seq
+        self._frame_cursor = 0
+
+    def release(self) -> None:
+        pass
+
+    def is_live(self) -> bool:
+        return self._is_live
+
+    def _get_range(self) -> Tuple[int, int]:
+        # 読み込めるフレーム番号の範囲[first, end)
+        if self._is_live:
+            first_seq, end_seq = self._ring.get_range()
+            return max(0, first_seq - self._first_seq), end_seq - self._first_seq
+        return 0, self._frame_num
+
+    def read(self) -> cv2.Mat:
+        while True:
+            first, end = self._get_range()
+            if self._frame_cursor < first:
+                # 読み込む前に上書きされてしまった場合は残っている先頭から読む
+                self._frame_cursor = first
+            if self._frame_cursor >= end:
+                return None
+            seq = self._first_seq + self._frame_cursor
+            if self._is_live and isinstance(self._ring, MmapFrameRing):
+                # 書き込み中のリングのビューは表示する前に上書きされることがあるため、コピーして読み込む
+                frame = self._ring.get_copy(seq)
+                if frame is None:
+                    # 上書きされている、または上書きされる途中のフレームは飛ばして読み直す
+                    self._frame_cursor = max(self._frame_cursor + 1, first)
+                    continue
+            else:
+                frame = self._ring.get(seq)
+            if frame is not None:
+                self._frame_cursor += 1
+            return frame
 
-        frame_cursor += self._frame_cursor
-        return frame_cursor - 1
+    def move_first(self) -> None:
+        self._frame_cursor = self._get_range()[0]
+
+    def move_last(self) -> None:
+        first, end = self._get_range()
+        self._frame_cursor = max(first, end - 1)
+
+    def move_diff(self, diff: int) -> None:
+        self.move_frame(self._frame_cursor + diff)
+
+    def move_frame(self, frame_num: int) -> None:
+        # 範囲オーバーの場合もエラーにならず端で止まる
+        first, end = self._get_range()
+        self._frame_cursor = min(max(first, frame_num), max(first, end - 1))
+
+    def get_first_frame(self) -> int:
+        return self._get_range()[0]
+
+    def get_frame_num(self) -> int:
+        return self._get_range()[1]
+
+    def get_now_frame(self) -> int:
+        # RingVideoCaptureと同様に直前に読み込んだフレームの番号を返す
+        return self._frame_cursor - 1
+
+    def get_timestamp(self, frame_num: int) -> Optional[float]:
+        # 録画時のタイムスタンプ(time.monotonic)。上書きされたフレームの場合はNone
+        return self._ring.get_timestamp(self._first_seq + frame_num)
+
+    def get_global_frame(self, frame_num: int) -> Optional[int]:
+        # リングのseq
+        return self._first_seq + frame_num
+
+    def read_approximate(self, frame_num: int, distance_max: int = 0) -> Optional[cv2.Mat]:  # NOQA
+        # リングはどのフレームも直接読み込めるため、近似のフレームは使わない
+        return None
+
+
+class DecoderCommand(Enum):
+    STEP = auto()  # 表示中のフレームから指定数だけ移動して読み込む
+    SEEK = auto()  # 指定のフレームに移動して読み込む
+    FIRST = auto()
+    LAST = auto()
+    PLAY = auto()
+    PLAY_REVERSE = auto()
+    STOP = auto()  # 再生を止めて、指定のフレーム(最後に表示したフレーム)に戻る
+
+
+class FrameDecoder(object):
+    """
+    キャプチャの操作をすべて1つのスレッドで行う。
+    コマ送り、シーク、再生などはコマンドとしてキューに積み、スレッドが順に処理する。
+
+    * コマ送り、シークで読み込んだフレームはframe_callbackに渡す。
+    * 続けて積まれたSTEPは移動量をまとめ、続けて積まれたSEEKは最新のものだけを残す。
+    * SEEKと2フレーム以上のSTEPは、正確なフレームの前にread_approximateで得られる近いフレームを先にframe_callbackへ渡す。
+      settle_time秒待つまでに次のコマンドが積まれた場合は正確なフレームを読まずに次へ進む。
+      プロキシを使う場合はsettle_timeを指定し、操作が止まったときだけマスターをデコードする。
+    * 再生中は先のフレームを読み込んでバッファに溜めておき、getで取り出す。
+      逆再生の場合は数フレームずつ前向きにまとめてデコードし、逆順にバッファへ積む。
+    """
+
+    def __init__(
+        self,
+        capture: Union[RingVideoCapture, FrameRingCapture],
+        frame_callback: Callable[[DecoderCommand, int, cv2.Mat, bool], None],
+        max_buffer_num: int = 30,
+        chunk_size: int = 24,
+        settle_time: float = 0.0,
+    ):
+        self._capture = capture
+        self._frame_callback = frame_callback  # (コマンド, フレーム番号, フレーム, 正確なフレームかどうか)
+        self._chunk_size = chunk_size
+        self._settle_time = settle_time
+        self._commands: List[Tuple[DecoderCommand, int]] = []
+        self._condition = Condition()
+        self._buffer = queue.Queue(maxsize=max_buffer_num)
+        self._play_session = 0  # 再生ごとに増やし、前の再生で積まれたフレームを区別する
+        self._session = 0  # 先読みしているフレームの再生の番号
+        self._playing: Optional[DecoderCommand] = None
+        self._reverse_end = 0  # 逆再生で次にデコードするまとまりの終端
+        self._now_frame = capture.get_now_frame()
+        self._play_start_frame: Optional[int] = None  # 再生を始めたときに表示していたフレーム
+        self._is_run = True
+        self.underrun_count = 0  # 再生中にバッファが空だった回数
+        self.skipped_seek_count = 0  # 実行される前に新しいシークで置き換えられた回数
+        self._decode_thread = Thread(target=self._decode_task)
+        self._decode_thread.start()
+
+    def step(self, diff: int) -> None:
+        self._push(DecoderCommand.STEP, diff)
+
+    def seek(self, frame_num: int) -> None:
+        self._push(DecoderCommand.SEEK, frame_num)
+
+    def move_first(self) -> None:
+        self._push(DecoderCommand.FIRST)
+
+    def move_last(self) -> None:
+        self._push(DecoderCommand.LAST)
+
+    def play(self, is_reverse: bool = False) -> int:
+        # 再生を始め、getで使う再生の番号を返す
+        with self._condition:
+            self._play_session += 1
+            session = self._play_session
+        self._push(DecoderCommand.PLAY_REVERSE if is_reverse else DecoderCommand.PLAY, session)
+        return session
+
+    def stop_play(self, played_frame_num: Optional[int]) -> None:
+        # played_frame_numを指定した場合は再生を止めた後にそのフレームへ戻る
+        with self._condition:
+            self._play_session += 1
+        self._push(DecoderCommand.STOP, -1 if played_frame_num is None else played_frame_num)
+
+    def get(self, session: int, timeout: float = 0.1) -> Optional[Tuple[int, Optional[cv2.Mat]]]:
+        """
+        再生中のフレームを(フレーム番号, フレーム)で返す。最後まで読み終わった場合はフレームがNoneになる。
+        timeoutまでに読み込みが間に合わなかった場合や、再生が止められた場合はNoneを返す。
+        """
+        end_time = perf_counter() + timeout
+        is_underrun = False
+        while session == self._play_session:
+            try:
+                item_session, item = self._buffer.get(timeout=0.01)
+            except queue.Empty:
+                if not is_underrun:
+                    is_underrun = True
+                    self.underrun_count += 1
+                if perf_counter() > end_time:
+                    return None
+                continue
+            if item_session == session:
+                return item
+        return None
+
+    def poll(self, session: int) -> Optional[Tuple[int, Optional[cv2.Mat]]]:
+        # バッファに溜まっている場合だけ再生中のフレームを返す。待たずにNoneを返した場合もアンダーランには数えない
+        while session == self._play_session:
+            try:
+                item_session, item = self._buffer.get_nowait()
+            except queue.Empty:
+                return None
+            if item_session == session:
+                return item
+        return None
+
+    def is_session_active(self, session: int) -> bool:
+        # sessionの再生が止められておらず、デコーダも閉じられていない
+        return session == self._play_session and self._is_run
+
+    def get_now_frame(self) -> int:
+        # 直前にframe_callbackに渡した、または再生中に読み込んだフレームの番号
+        return self._now_frame
+
+    def release(self) -> None:
+        # スレッドを止めてキャプチャを閉じる
+        with self._condition:
+            self._is_run = False
+            self._play_session += 1
+            self._condition.notify_all()
+        self._decode_thread.join()
+        self._capture.release()
+
+    def _push(self, command: DecoderCommand, value: int = 0) -> None:
+        with self._condition:
+            last = self._commands[-1] if len(self._commands) > 0 else None
+            if last is not None and last[0] == command == DecoderCommand.STEP:
+                self._commands[-1] = (command, last[1] + value)
+            elif last is not None and last[0] == command == DecoderCommand.SEEK:
+                self._commands[-1] = (command, value)
+                self.skipped_seek_count += 1
+            else:
+                self._commands.append((command, value))
+            self._condition.notify_all()
+
+    def _has_command(self) -> bool:
+        with self._condition:
+            return len(self._commands) > 0
+
+    def _pop(self, timeout: Optional[float]) -> Optional[Tuple[DecoderCommand, int]]:
+        with self._condition:
+            if len(self._commands) == 0 and self._is_run:
+                self._condition.wait(timeout)
+            if len(self._commands) == 0:
+                return None
+            return self._commands.pop(0)
+
+    def _decode_task(self) -> None:
+        while self._is_run:
+            # 再生中はコマンドが無ければ先読みを進める
+            command = self._pop(None if self._playing is None else 0)
+            if command is not None:
+                self._execute(*command)
+            elif self._playing == DecoderCommand.PLAY:
+                self._decode_forward()
+            elif self._playing == DecoderCommand.PLAY_REVERSE:
+                self._decode_reverse()
+
+    def _execute(self, command: DecoderCommand, value: int) -> None:
+        if command == DecoderCommand.STEP:
+            # 表示中のフレームから移動する
+            frame_num = self._now_frame + value
+            if abs(value) > 1 and self._show_approximate(command, frame_num):
+                return
+            self._capture.move_frame(frame_num)
+            self._read_and_callback(command)
+        elif command == DecoderCommand.SEEK:
+            if self._show_approximate(command, value):
+                return
+            self._capture.move_frame(value)
+            self._read_and_callback(command)
+        elif command == DecoderCommand.FIRST:
+            self._capture.move_first()
+            self._read_and_callback(command)
+        elif command == DecoderCommand.LAST:
+            self._capture.move_last()
+            self._read_and_callback(command)
+        elif command in (DecoderCommand.PLAY, DecoderCommand.PLAY_REVERSE):
+            self._clear_buffer()
+            self._playing = command
+            self._session = value
+            if self._capture.get_now_frame() != self._now_frame:
+                # 近いフレームだけを表示していた場合は、表示中のフレームの次から読み込む
+                self._capture.move_frame(self._now_frame + 1)
+            self._reverse_end = self._now_frame
+            self._play_start_frame = self._now_frame
+        elif command == DecoderCommand.STOP:
+            self._playing = None
+            self._clear_buffer()
+            if value < 0 and self._play_start_frame is not None:
+                # 1フレームも表示せずに止めた場合は、再生を始めたときに表示していたフレームに戻す
+                value = self._play_start_frame
+            self._play_start_frame = None
+            if value >= 0:
+                # 先読みした分だけ進んだカーソルを最後に表示したフレームの直後に戻す
+                self._capture.move_frame(value)
+                self._capture.read()
+                self._now_frame = value
+
+    def _show_approximate(self, command: DecoderCommand, frame_num: int) -> bool:
+        # 近いフレームをframe_callbackに渡し、正確なフレームを読む前に次のコマンドが積まれた場合はTrueを返す
+        first = self._capture.get_first_frame()
+        frame_num = min(max(first, frame_num), max(first, self._capture.get_frame_num() - 1))
+        frame = self._capture.read_approximate(frame_num)
+        if frame is None:
+            return False
+        self._frame_callback(command, frame_num, frame, False)
+        with self._condition:
+            if len(self._commands) == 0 and self._is_run and self._settle_time > 0:
+                self._condition.wait(self._settle_time)
+            if len(self._commands) == 0 and self._is_run:
+                return False
+        # 正確なフレームは読まないが、続くSTEPは表示したフレームから移動する
+        self._now_frame = frame_num
+        return True
+
+    def _read_and_callback(self, command: DecoderCommand) -> None:
+        frame = self._capture.read()
+        self._now_frame = self._capture.get_now_frame()
+        if frame is not None:
+            self._frame_callback(command, self._now_frame, frame, True)
+
+    def _clear_buffer(self) -> None:
+        try:
+            while True:
+                self._buffer.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _put(self, item: Tuple[int, Optional[cv2.Mat]]) -> bool:
+        # コマンドが積まれた場合や停止された場合はFalseを返す
+        while self._is_run and not self._has_command():
+            try:
+                self._buffer.put((self._session, item), timeout=0.01)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode_forward(self) -> None:
+        frame = self._capture.read()
+        if frame is None and self._capture.is_live():
+            # 録画中の端に追いついた場合は次のフレームが書き込まれるのを待つ
+            with self._condition:
+                self._condition.wait(0.005)
+            return
+        self._now_frame = self._capture.get_now_frame()
+        self._put((self._now_frame, frame))
+        if frame is None:
+            self._playing = None
+
+    def _decode_reverse(self) -> None:
+        # 直前に表示したフレームの1つ前から先頭に向かってまとめて読み込む
+        first = self._capture.get_first_frame()
+        end = self._reverse_end
+        if end <= first:
+            self._put((first, None))
+            self._playing = None
+            return
+        start = max(first, end - self._chunk_size)
+        self._capture.move_frame(start)
+        chunk = []
+        for _ in range(end - start):
+            frame = self._capture.read()
+            if frame is None:
+                break
+            chunk.append((self._capture.get_now_frame(), frame))
+        self._reverse_end = start
+        for item in reversed(chunk):
+            if not self._put(item):
+                return
+            self._now_frame = item[0]
@@ -0,0 +1,74 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+import math
+import os
+import shutil
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional
+
+
+@dataclass
+class SegmentInfo(object):
+    file_path: str
+    byte_num: int
+    length: float  # 秒数
+
+
+def get_free_byte_num(folder_path: str) -> int:
+    # フォルダがあるディスクの空き容量
+    os.makedirs(folder_path, exist_ok=True)
+    return shutil.disk_usage(folder_path).free
+
+
+class StoragePlanner(object):
+    """
+    書き込み済みのセグメントのサイズから実際のビットレートを測り、byte_budgetに収まるセグメント数を決める。
+    ビットレートが分かるまではすべてのセグメントを使う。
+    収まるセグメント数が足りない場合はリプレイできる長さが設定より短くなる(get_retainable_length)。
+    """
+
+    FILE_NUM_MIN = 2  # 書き込み中のセグメントと直前のセグメント
+
+    def __init__(self, byte_budget: int, file_num: int, file_length: float):
+        self._byte_budget = byte_budget
+        self._file_num = file_num
+        self._file_length = file_length
+        self._byte_num_total = 0
+        self._length_total = 0.0
+        self._lock = Lock()
+
+    def add_segment(self, segment: SegmentInfo) -> None:
+        # lengthが0のセグメント(プロキシ)はサイズだけを加える
+        if segment.length <= 0 and segment.byte_num <= 0:
+            return
+        with self._lock:
+            self._byte_num_total += segment.byte_num
+            self._length_total += segment.length
+
+    def get_byte_rate(self) -> Optional[float]:
+        # 1秒あたりのバイト数。まだ測れていない場合はNone
+        with self._lock:
+            if self._length_total <= 0:
+                return None
+            return self._byte_num_total / self._length_total
+
+    def get_file_num(self) -> int:
+        # byte_budgetに収まるセグメント数
+        byte_rate = self.get_byte_rate()
+        if byte_rate is None or byte_rate <= 0:
+            return self._file_num
+        segment_byte_num = byte_rate * self._file_length
+        file_num = math.floor(self._byte_budget / segment_byte_num)
+        return max(StoragePlanner.FILE_NUM_MIN, min(self._file_num, file_num))
+
+    def get_retainable_length(self) -> float:
+        # 保持できるリプレイの長さ[s]。書き込み中のセグメントの分は除く。
+        # すべてのファイルを使う場合は、切り替えの前に次のファイル(最も古いセグメント)を開いて中身が消えるため、その分も除く。
+        # ファイル数を減らしている場合は、次のファイルは既に消したファイルになる
+        file_num = self.get_file_num()
+        if file_num >= self._file_num:
+            return max(0, file_num - 2) * self._file_length
+        return (file_num - 1) * self._file_length
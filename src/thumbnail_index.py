@@ -0,0 +1,62 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+from bisect import bisect_left, insort
+from threading import Lock
+from typing import Dict, List, Optional
+
+import cv2
+
+
+def make_thumbnail(image: cv2.Mat, width: int) -> cv2.Mat:
+    # 縦横比を保ったまま幅をwidthまで縮小する
+    height, image_width = image.shape[:2]
+    width = min(width, image_width)
+    return cv2.resize(image, (width, max(1, round(height * width / image_width))), interpolation=cv2.INTER_AREA)
+
+
+class ThumbnailIndex(object):
+    """
+    録画中にintervalフレームごとの縮小画像を作り、フレームの通し番号をキーにして保持する。
+    シークバーの操作中に、デコードせずに近い位置の画像を表示するために使う。
+    保持する数がthumbnail_num_maxを超えた場合は番号の小さいものから捨てる。
+    """
+
+    def __init__(self, interval: int, width: int, thumbnail_num_max: int):
+        self.interval = interval
+        self.width = width
+        self._thumbnail_num_max = thumbnail_num_max
+        self._thumbnails: Dict[int, cv2.Mat] = {}
+        self._frame_nums: List[int] = []  # 昇順
+        self._lock = Lock()
+
+    def add_frame(self, frame_num: int, image: cv2.Mat) -> None:
+        # 書き込みスレッドから全てのフレームについて呼ぶ。intervalごとのフレームだけを縮小して保持する
+        if frame_num % self.interval == 0:
+            self.put(frame_num, make_thumbnail(image, self.width))
+
+    def put(self, frame_num: int, thumbnail: cv2.Mat) -> None:
+        with self._lock:
+            if frame_num not in self._thumbnails:
+                insort(self._frame_nums, frame_num)
+            self._thumbnails[frame_num] = thumbnail
+            while len(self._frame_nums) > self._thumbnail_num_max:
+                del self._thumbnails[self._frame_nums.pop(0)]
+
+    def get_nearest(self, frame_num: int) -> Optional[cv2.Mat]:
+        # frame_numに最も近いサムネイル。interval以上離れたものしか無い場合はNone
+        with self._lock:
+            i = bisect_left(self._frame_nums, frame_num)
+            candidates = self._frame_nums[max(0, i - 1) : i + 1]
+            if len(candidates) == 0:
+                return None
+            nearest = min(candidates, key=lambda candidate: abs(candidate - frame_num))
+            if abs(nearest - frame_num) >= self.interval:
+                return None
+            return self._thumbnails[nearest]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._thumbnails.clear()
+            self._frame_nums.clear()
@@ -0,0 +1,9 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+import os
+import sys
+
+# src内のモジュールは互いにモジュール名だけでimportしているため、srcをパスに加える
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,170 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+"""
+画面を使わずに、JpegFrameRingを読み込むFrameRingCaptureでFrameDecoderの動作を確認する。
+各フレームはフレーム番号と同じ値で塗りつぶしておき、表示されたフレームの中身から番号を確認する。
+
+例) python -m pytest tests
+"""
+
+import queue
+from threading import Event
+from typing import Tuple
+
+import cv2
+import numpy as np
+import pytest
+
+from ring_video import DecoderCommand, FrameDecoder, FrameRingCapture, JpegFrameRing
+
+WIDTH = 32
+HEIGHT = 24
+FRAME_RATE = 60
+FRAME_NUM = 200
+TIMEOUT = 5.0  # 秒数
+
+
+def to_value(frame: cv2.Mat) -> int:
+    # 塗りつぶした値(フレーム番号)。JPEGの誤差を丸める
+    return int(round(float(frame.mean())))
+
+
+class DecoderRecorder(object):
+    """
+    frame_callbackに渡されたフレームを順に受け取る。
+    blockを呼ぶと、次のframe_callbackをreleaseまで止めてデコードスレッドにコマンドが溜まるようにする。
+    """
+
+    def __init__(self):
+        self.frames: "queue.Queue[Tuple[DecoderCommand, int, int]]" = queue.Queue()
+        self._is_blocking = False
+        self._blocked = Event()
+        self._released = Event()
+
+    def callback(self, command: DecoderCommand, frame_num: int, frame: cv2.Mat, is_exact: bool) -> None:  # NOQA
+        self.frames.put((command, frame_num, to_value(frame)))
+        if self._is_blocking:
+            self._is_blocking = False
+            self._blocked.set()
+            self._released.wait(TIMEOUT)
+
+    def block(self) -> None:
+        self._blocked.clear()
+        self._released.clear()
+        self._is_blocking = True
+
+    def wait_blocked(self) -> None:
+        assert self._blocked.wait(TIMEOUT)
+
+    def release(self) -> None:
+        self._released.set()
+
+    def get(self) -> Tuple[DecoderCommand, int, int]:
+        return self.frames.get(timeout=TIMEOUT)
+
+
+@pytest.fixture
+def ring() -> JpegFrameRing:
+    ring = JpegFrameRing(FRAME_NUM)
+    for i in range(FRAME_NUM):
+        ring.put(np.full((HEIGHT, WIDTH, 3), i, dtype=np.uint8), i / FRAME_RATE)
+    return ring
+
+
+@pytest.fixture
+def recorder() -> DecoderRecorder:
+    return DecoderRecorder()
+
+
+@pytest.fixture
+def decoder(ring, recorder):
+    decoder = FrameDecoder(FrameRingCapture(ring), recorder.callback, max_buffer_num=10, chunk_size=8)
+    yield decoder
+    recorder.release()
+    decoder.release()
+
+
+def seek_and_wait(decoder: FrameDecoder, recorder: DecoderRecorder, frame_num: int) -> None:
+    decoder.seek(frame_num)
+    assert recorder.get() == (DecoderCommand.SEEK, frame_num, frame_num)
+
+
+def play_frames(decoder: FrameDecoder, is_reverse: bool, frame_num: int):
+    # 再生を始めて、先頭からframe_num個のフレームを(フレーム番号, 値)で返す
+    session = decoder.play(is_reverse)
+    items = []
+    for _ in range(frame_num):
+        item = decoder.get(session, TIMEOUT)
+        assert item is not None
+        items.append((item[0], None if item[1] is None else to_value(item[1])))
+    return items
+
+
+def test_step_merge(decoder, recorder):
+    # 実行前に積まれた連続するSTEPは1つにまとめられ、移動量の合計だけ進んだフレームだけが表示される
+    recorder.block()
+    decoder.seek(50)
+    recorder.wait_blocked()
+    for _ in range(5):
+        decoder.step(1)
+    decoder.step(-2)
+    recorder.release()
+    assert recorder.get() == (DecoderCommand.SEEK, 50, 50)
+    assert recorder.get() == (DecoderCommand.STEP, 53, 53)
+    with pytest.raises(queue.Empty):
+        recorder.frames.get(timeout=0.2)
+    assert decoder.get_now_frame() == 53
+
+
+def test_seek_coalesce(decoder, recorder):
+    # 実行前に積まれた連続するSEEKは最新のものだけが実行される
+    recorder.block()
+    decoder.seek(10)
+    recorder.wait_blocked()
+    for frame_num in [20, 30, 40, 120]:
+        decoder.seek(frame_num)
+    recorder.release()
+    assert recorder.get() == (DecoderCommand.SEEK, 10, 10)
+    assert recorder.get() == (DecoderCommand.SEEK, 120, 120)
+    with pytest.raises(queue.Empty):
+        recorder.frames.get(timeout=0.2)
+    assert decoder.skipped_seek_count == 3
+
+
+def test_play_forward(decoder, recorder):
+    # 表示中のフレームの次から順に読み込み、最後まで読むとフレームがNoneになる
+    seek_and_wait(decoder, recorder, FRAME_NUM - 20)
+    items = play_frames(decoder, False, 20)
+    assert items[:-1] == [(i, i) for i in range(FRAME_NUM - 19, FRAME_NUM)]
+    assert items[-1][1] is None
+
+
+def test_play_reverse(decoder, recorder):
+    # 表示中のフレームの1つ前から先頭に向かって読み込み、先頭まで読むとフレームがNoneになる
+    seek_and_wait(decoder, recorder, 20)
+    items = play_frames(decoder, True, 21)
+    assert items[:-1] == [(i, i) for i in range(19, -1, -1)]
+    assert items[-1][1] is None
+
+
+@pytest.mark.parametrize("is_reverse", [False, True])
+def test_stop_restores_played_frame(decoder, recorder, is_reverse):
+    # 先読みした分だけ進んでいても、止めた後は最後に表示したフレームから移動する
+    seek_and_wait(decoder, recorder, 100)
+    items = play_frames(decoder, is_reverse, 3)
+    played_frame_num = items[-1][0]
+    decoder.stop_play(played_frame_num)
+    decoder.step(1)
+    assert recorder.get() == (DecoderCommand.STEP, played_frame_num + 1, played_frame_num + 1)
+
+
+@pytest.mark.parametrize("is_reverse", [False, True])
+def test_stop_without_played_frame(decoder, recorder, is_reverse):
+    # 1フレームも表示せずに止めた場合は、再生を始めたときに表示していたフレームから移動する
+    seek_and_wait(decoder, recorder, 100)
+    play_frames(decoder, is_reverse, 5)
+    decoder.stop_play(None)
+    decoder.step(1)
+    assert recorder.get() == (DecoderCommand.STEP, 101, 101)
@@ -0,0 +1,136 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+"""
+カメラを使わずに、SyntheticFrameSourceの映像をRingVideoWriterで書き込み、RingVideoCaptureで読み込めることを確認する。
+mp4vは非可逆圧縮のため、各セグメントを先頭から順にデコードした結果を正解として、同じフレームが返ることを確認する。
+
+例) python -m pytest tests
+"""
+
+import os
+import random
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+
+from frame_source import SyntheticFrameSource
+from ring_video import OverflowPolicy, RingVideoCapture, RingVideoWriter
+
+WIDTH = 160
+HEIGHT = 120
+FRAME_RATE = 30
+FILE_LENGTH = 1  # 秒数
+FILE_NUM = 4
+FRAME_NUM = FRAME_RATE * 5  # 最初のセグメントが上書きされるように、FILE_NUM * FILE_LENGTHより長く書き込む
+
+
+@pytest.fixture(scope="module")
+def file_list(tmp_path_factory) -> List[str]:
+    # 書き込み済みのセグメントを古い順に返す
+    folder = tmp_path_factory.mktemp("ring_video")
+    files = [os.path.join(folder, f"output{i}.mp4") for i in range(FILE_NUM)]
+    source = SyntheticFrameSource(WIDTH, HEIGHT, FRAME_RATE, is_realtime=False, frame_num_max=FRAME_NUM)
+    # 書き込みが追いつかずにフレームが落ちないようにBLOCKにする
+    writer = RingVideoWriter(
+        files,
+        cv2.VideoWriter_fourcc(*"mp4v"),
+        FRAME_RATE,
+        (WIDTH, HEIGHT),
+        FILE_LENGTH,
+        overflow_policy=OverflowPolicy.BLOCK,
+    )
+    frame_num = 0
+    while True:
+        ret, frame = source.read()
+        if not ret:
+            break
+        # タイムスタンプはフレームレートどおりの間隔にする
+        writer.write(frame.copy(), frame_num / FRAME_RATE)
+        frame_num += 1
+    return writer.release()
+
+
+@pytest.fixture(scope="module")
+def reference(file_list) -> List[cv2.Mat]:
+    # 各セグメントを先頭から順にデコードしてつなげたもの
+    frames = []
+    for file in file_list:
+        if not os.path.exists(file):
+            continue
+        capture = cv2.VideoCapture(file)
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            frames.append(frame)
+        capture.release()
+    return frames
+
+
+def test_reference_matches_source(reference):
+    # 正解に使うフレームが、書き込んだ映像の最後の部分と同じ順番になっていることを確認する
+    assert 0 < len(reference) <= FRAME_NUM
+    first_frame_num = FRAME_NUM - len(reference)
+    background = SyntheticFrameSource(WIDTH, HEIGHT)._background
+    sources = [SyntheticFrameSource.generate(first_frame_num + i, background) for i in range(len(reference))]
+    for i in range(0, len(reference), 7):
+        errors = [np.abs(reference[i].astype(int) - source.astype(int)).mean() for source in sources]
+        assert int(np.argmin(errors)) == i
+
+
+def test_sequential_read(file_list, reference):
+    capture = RingVideoCapture(file_list)
+    assert capture.get_frame_num() == len(reference)
+    capture.move_first()
+    for i, expected in enumerate(reference):
+        frame = capture.read()
+        assert frame is not None
+        assert capture.get_now_frame() == i
+        assert np.array_equal(frame, expected)
+    assert capture.read() is None
+    capture.release()
+
+
+def test_random_seek(file_list, reference):
+    capture = RingVideoCapture(file_list)
+    random.seed(0)
+    for frame_num in random.sample(range(len(reference)), 40):
+        capture.move_frame(frame_num)
+        frame = capture.read()
+        assert capture.get_now_frame() == frame_num
+        assert np.array_equal(frame, reference[frame_num])
+    capture.release()
+
+
+def test_move_diff_backward(file_list, reference):
+    # コマ戻しと同じく、読み込んだ後に2つ戻ると1つ前のフレームになる
+    capture = RingVideoCapture(file_list)
+    capture.move_last()
+    frame_num = capture.get_now_frame() + 1
+    capture.read()
+    while frame_num > 1:
+        capture.move_diff(-2)
+        frame = capture.read()
+        frame_num -= 1
+        assert capture.get_now_frame() == frame_num
+        assert np.array_equal(frame, reference[frame_num])
+    capture.release()
+
+
+def test_retention(file_list, reference):
+    # 最後のフレームからretention_length秒前までのフレームだけが対象になる
+    retention_length = 1.5
+    capture = RingVideoCapture(file_list, retention_length=retention_length)
+    frame_num = int(retention_length * FRAME_RATE) + 1
+    assert capture.get_frame_num() == frame_num
+    expected = reference[len(reference) - frame_num :]
+    for frame_num in [0, 1, frame_num // 2, frame_num - 1]:
+        capture.move_frame(frame_num)
+        assert np.array_equal(capture.read(), expected[frame_num])
+    last = capture.get_timestamp(capture.get_frame_num() - 1)
+    assert last - capture.get_timestamp(0) == pytest.approx(retention_length)
+    capture.release()
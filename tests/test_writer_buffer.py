@@ -0,0 +1,101 @@
+# Copyright (c) 2022 Nanahuse
+# This software is released under the MIT License
+# https://github.com/Nanahuse/QuickReplay/blob/main/LICENSE
+
+"""
+WriterBufferが満杯のときに、OverflowPolicyごとにどのフレームを捨てるかを確認する。
+フレームはFramePoolから借りたPooledFrameを使い、捨てたフレームがプールに戻ることも確認する。
+
+例) python -m pytest tests
+"""
+
+import queue
+from threading import Thread
+from typing import List, Optional
+
+import cv2
+import numpy as np
+import pytest
+
+from frame_pool import FramePool
+from ring_video import OverflowPolicy, WriterBuffer
+
+BUFFER_NUM = 4
+FRAME_NUM = 10
+TIMEOUT = 5.0  # 秒数
+
+
+class RecordingPool(FramePool):
+    # プールに戻ったフレームの値(フレーム番号)を記録する
+    def __init__(self):
+        super().__init__(FRAME_NUM)
+        self.returned: List[int] = []
+
+    def _give_back(self, image: Optional[cv2.Mat]) -> None:
+        self.returned.append(int(image[0, 0, 0]))
+        super()._give_back(image)
+
+
+def put_frame(buffer: WriterBuffer, pool: RecordingPool, frame_num: int) -> None:
+    # 録画のループと同じく、プールから借りてバッファに入れた後に自分の参照を戻す
+    pooled_frame = pool.acquire()
+    pooled_frame.image = np.full((1, 1, 3), frame_num, dtype=np.uint8)
+    buffer.put((pooled_frame, frame_num / 60))
+    pooled_frame.release()
+
+
+def drain(buffer: WriterBuffer) -> List[int]:
+    # 書き込みスレッドと同じく、取り出したフレームを書き込んだものとしてプールに戻す
+    frame_nums = []
+    while True:
+        try:
+            pooled_frame, _ = buffer.get(timeout=0.01)
+        except queue.Empty:
+            return frame_nums
+        frame_nums.append(int(pooled_frame.image[0, 0, 0]))
+        pooled_frame.release()
+
+
+@pytest.mark.parametrize(
+    "policy, kept",
+    [
+        (OverflowPolicy.DROP_NEWEST, [0, 1, 2, 3]),
+        (OverflowPolicy.DROP_OLDEST, [6, 7, 8, 9]),
+        # 半分以上埋まってからは1フレームおきに捨て、満杯になった後は全て捨てる
+        (OverflowPolicy.ADAPTIVE, [0, 1, 3, 5]),
+    ],
+)
+def test_drop_policy(policy, kept):
+    pool = RecordingPool()
+    buffer = WriterBuffer(BUFFER_NUM, policy)
+    for frame_num in range(FRAME_NUM):
+        put_frame(buffer, pool, frame_num)
+    dropped = [frame_num for frame_num in range(FRAME_NUM) if frame_num not in kept]
+    assert buffer.dropped_frame_num == len(dropped)
+    assert buffer.high_water_num == len(kept)
+    # 捨てたフレームだけがプールに戻り、バッファに残っているフレームは戻らない
+    assert sorted(pool.returned) == dropped
+    assert drain(buffer) == kept
+    assert sorted(pool.returned) == list(range(FRAME_NUM))
+
+
+def test_block():
+    # 満杯のときは捨てずに、取り出されて空きができるまで待つ
+    pool = RecordingPool()
+    buffer = WriterBuffer(BUFFER_NUM, OverflowPolicy.BLOCK)
+    for frame_num in range(BUFFER_NUM):
+        put_frame(buffer, pool, frame_num)
+    thread = Thread(target=put_frame, args=(buffer, pool, BUFFER_NUM))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    pooled_frame, _ = buffer.get(timeout=TIMEOUT)
+    pooled_frame.release()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive()
+    assert buffer.dropped_frame_num == 0
+    assert buffer.high_water_num == BUFFER_NUM
+    assert pool.returned == [0]
+    assert drain(buffer) == list(range(1, BUFFER_NUM + 1))
+    assert sorted(pool.returned) == list(range(BUFFER_NUM + 1))